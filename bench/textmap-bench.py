@@ -0,0 +1,336 @@
+#!/usr/bin/env  python
+###
+# Copyright (c) 2006, Jim Richardson <weaselkeeper@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+
+ Benchmarks for textmap.py. Builds synthetic corpora of a few sizes and
+ kinds (english like text, uniform random bytes, and base64 armored
+ pseudo ciphertext), then times each stage of the pipeline on them: plain
+ reading, counting (with each backend), layout (build_coords), rendering
+ (build_postscript) and the whole massage() run end to end. Every
+ measurement runs in a fresh interpreter so peak RSS means something.
+ Results are printed as a table and can be saved as json, to compare
+ against a later run or another backend. Everything is generated locally
+ from a fixed seed, no network needed.
+"""
+
+PROJECTNAME = 'textmap-bench'
+
+import sys
+import os
+import json
+import time
+import base64
+import random
+import binascii
+import platform
+import resource
+import tempfile
+import subprocess
+import logging
+# Setup logging
+logging.basicConfig(level=logging.WARN,
+                    format='%(asctime)s %(levelname)s - %(message)s',
+                    datefmt='%y.%m.%d %H:%M:%S')
+
+# Setup logging to console.
+console = logging.StreamHandler(sys.stderr)
+console.setLevel(logging.WARN)
+logging.getLogger(PROJECTNAME).addHandler(console)
+log = logging.getLogger(PROJECTNAME)
+
+SRCDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                      'src')
+sys.path.insert(0, SRCDIR)
+import textmap
+
+# Setting some constants
+SEED = 2006
+BLOCK = 1024 * 1024
+KINDS = ['english', 'random', 'cipher']
+STAGES = ['read', 'count', 'layout', 'render', 'massage']
+# Only these stages care which counting backend is in use.
+BACKEND_STAGES = ['count', 'massage']
+# Rough english word list, most common first, weighted zipf style below.
+WORDS = """the of and to a in is it you that he was for on are with as I his
+they be at one have this from or had by hot word but what some we can out
+other were all there when up use your how said an each she which do their
+time if will way about many then them write would like so these her long
+make thing see him two has look more day could go come did number sound no
+most people my over know water than call first who may down side been now
+find any new work part take get place made live where after back little
+only round man year came show every good me give our under name very
+through just form sentence great think say help low line differ turn cause
+much mean before move right boy old too same tell does set three want air
+well also play small end put home read hand port large spell add even land
+here must big high such follow act why ask men change went light kind off
+need house picture try us again animal point mother world near build self
+earth father head stand own page should country found answer school grow
+study still learn plant cover food sun four between state keep eye never
+last let thought city tree cross farm hard start might story saw far sea
+draw left late run don't while press close night real life few north
+""".split()
+
+
+def get_options():
+    """ Parse for any options """
+    log.debug('in get_options')
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Benchmark the textmap pipeline.')
+    parser.add_argument('-s', '--sizes', action='store', default='1M,16M,256M',
+                        help='comma separated corpus sizes, K/M/G suffixes '
+                        'allowed')
+    parser.add_argument('-k', '--kinds', action='store',
+                        default=','.join(KINDS),
+                        help='comma separated corpus kinds, from %s' %
+                        ', '.join(KINDS))
+    parser.add_argument('--stages', action='store', default=','.join(STAGES),
+                        help='comma separated stages, from %s' %
+                        ', '.join(STAGES))
+    parser.add_argument('--backends', action='store', default='python,numpy',
+                        help='counting backends to try')
+    parser.add_argument('-w', '--workdir', action='store',
+                        default=os.path.join(tempfile.gettempdir(),
+                                             PROJECTNAME),
+                        help='where the generated corpora are kept, they '
+                        'are reused between runs')
+    parser.add_argument('-r', '--repeat', action='store', type=int, default=3,
+                        help='runs per measurement, the best one is kept')
+    parser.add_argument('-o', '--output', action='store', default=None,
+                        help='save the results here as json')
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help='enable debugging')
+    parser.add_argument('--worker', action='store', default=None,
+                        help=argparse.SUPPRESS)
+    _args = parser.parse_args()
+    _args.usage = PROJECTNAME + ".py [options]"
+    log.debug('leaving get_options')
+    return _args
+
+
+def _random_bytes(rng, size):
+    """ size bytes from rng, the same on python 2 and 3. """
+    return binascii.unhexlify('%0*x' % (size * 2, rng.getrandbits(size * 8)))
+
+
+def _english_block(rng, size):
+    """ size bytes of word salad with roughly english letter and word
+    frequencies. """
+    weights = [1.0 / (rank + 1) for rank in range(len(WORDS))]
+    total = sum(weights)
+    cumulative = []
+    running = 0.0
+    for weight in weights:
+        running += weight / total
+        cumulative.append(running)
+    import bisect
+    words = []
+    length = 0
+    while length < size:
+        word = WORDS[min(bisect.bisect(cumulative, rng.random()),
+                         len(WORDS) - 1)]
+        if rng.random() < 0.08:
+            word = word.capitalize() + '.'
+        words.append(word)
+        length += len(word) + 1
+    text = ' '.join(words)
+    return text.encode('ascii')[:size]
+
+
+def make_block(kind, rng):
+    """ One BLOCK sized piece of a corpus of the given kind. """
+    if kind == 'english':
+        return _english_block(rng, BLOCK)
+    if kind == 'random':
+        return _random_bytes(rng, BLOCK)
+    if kind == 'cipher':
+        # base64 armor, 76 columns, like an ascii armored encrypted file.
+        raw = base64.b64encode(_random_bytes(rng, BLOCK * 3 // 4))
+        lines = [raw[i:i + 76] for i in range(0, len(raw), 76)]
+        return b'\n'.join(lines)[:BLOCK]
+    raise ValueError('unknown corpus kind %s' % kind)
+
+
+def make_corpus(workdir, kind, size):
+    """ Write (or reuse) a size byte corpus of kind under workdir. A handful
+    of distinct blocks are generated from SEED and cycled through, which
+    keeps multi gigabyte corpora quick to build. """
+    log.debug('in make_corpus')
+    path = os.path.join(workdir, '%s-%d.dat' % (kind, size))
+    if os.path.exists(path) and os.path.getsize(path) == size:
+        return path
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    log.warning('generating %s', path)
+    rng = random.Random('%s-%d' % (kind, SEED))
+    blocks = [make_block(kind, rng) for _i in range(8)]
+    temp = path + '.tmp'
+    output = open(temp, 'wb')
+    written = 0
+    while written < size:
+        block = blocks[(written // BLOCK) % len(blocks)]
+        block = block[:size - written]
+        output.write(block)
+        written += len(block)
+    output.close()
+    os.rename(temp, path)
+    log.debug('leaving make_corpus')
+    return path
+
+
+def peak_rss():
+    """ Peak resident set size of this process, in bytes. """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+
+def measure(stage, path, backend):
+    """ Run one stage once, in this process, and return seconds taken and
+    the bytes it got through. """
+    textmap.set_backend(backend)
+    size = os.path.getsize(path)
+    sink = os.devnull
+    if stage == 'read':
+        started = time.time()
+        # Plain reads, mapped pages would never actually get touched.
+        for _chunk in textmap.open_file(path, use_mmap=False):
+            pass
+        return time.time() - started, size
+    if stage == 'count':
+        started = time.time()
+        textmap.count_file(path, jobs=1)
+        return time.time() - started, size
+    symbols = textmap.histogram_to_dict(textmap.count_file(path, jobs=1))
+    char_sep = 360.0 / len(symbols)
+    if stage == 'layout':
+        started = time.time()
+        textmap.build_coords(symbols, char_sep)
+        return time.time() - started, 0
+    if stage == 'render':
+        coords = textmap.build_coords(symbols, char_sep)
+        started = time.time()
+        textmap.build_postscript(coords, sink)
+        return time.time() - started, 0
+    if stage == 'massage':
+        started = time.time()
+        textmap.massage(textmap.open_file(path), sink)
+        return time.time() - started, size
+    raise ValueError('unknown stage %s' % stage)
+
+
+def worker(spec):
+    """ --worker entry point, measure one stage and print the result as
+    json for the parent to pick up. """
+    stage, path, backend = spec.split(',', 2)
+    seconds, processed = measure(stage, path, backend)
+    json.dump({'seconds': seconds, 'bytes': processed,
+               'peak_rss': peak_rss()}, sys.stdout)
+    return 0
+
+
+def run_one(stage, path, backend, repeat):
+    """ Measure stage repeat times, each in a fresh interpreter, keeping
+    the fastest run and the highest peak RSS. """
+    best = None
+    for _i in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), '--worker',
+             ','.join([stage, path, backend])])
+        result = json.loads(output.decode('ascii'))
+        if best is None or result['seconds'] < best['seconds']:
+            rss = max(result['peak_rss'], best['peak_rss'] if best else 0)
+            best = result
+            best['peak_rss'] = rss
+    if best['bytes'] and best['seconds']:
+        best['mb_per_sec'] = best['bytes'] / best['seconds'] / 1e6
+    else:
+        best['mb_per_sec'] = None
+    return best
+
+
+def run():
+    """ The run() function, start here """
+    log.debug('in run')
+    if args.worker:
+        return worker(args.worker)
+    backends = args.backends.split(',')
+    if not textmap.have_numpy() and 'numpy' in backends:
+        log.warning('numpy is not installed, skipping the numpy backend')
+        backends.remove('numpy')
+    results = []
+    sys.stdout.write('%-8s %10s %-8s %-7s %10s %10s %10s\n' %
+                     ('kind', 'size', 'stage', 'backend', 'seconds', 'MB/s',
+                      'peak MB'))
+    for kind in args.kinds.split(','):
+        for size in [textmap.parse_size(text)
+                     for text in args.sizes.split(',')]:
+            path = make_corpus(args.workdir, kind, size)
+            for stage in args.stages.split(','):
+                for backend in (backends if stage in BACKEND_STAGES
+                                else backends[:1]):
+                    result = run_one(stage, path, backend, args.repeat)
+                    result.update({'kind': kind, 'size': size,
+                                   'stage': stage, 'backend': backend})
+                    results.append(result)
+                    sys.stdout.write(
+                        '%-8s %10d %-8s %-7s %10.4f %10s %10.1f\n' %
+                        (kind, size, stage, backend, result['seconds'],
+                         '%.1f' % result['mb_per_sec']
+                         if result['mb_per_sec'] else '-',
+                         result['peak_rss'] / 1e6))
+                    sys.stdout.flush()
+    if args.output:
+        output = open(args.output, 'w')
+        json.dump({'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'cpus': textmap.default_jobs(),
+                   'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'results': results}, output, indent=1, sort_keys=True)
+        output.close()
+    log.debug('leaving run')
+    return 0
+
+
+if __name__ == "__main__":
+    # This is where we will begin when called from CLI. No need for argparse
+    # unless being called interactively, so import it here, or at least, in
+    # get_options
+    args = get_options()
+
+    if args.debug:
+        log.setLevel(logging.DEBUG)
+    else:
+        log.setLevel(logging.WARN)
+
+    sys.exit(run())
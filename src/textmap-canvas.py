@@ -41,8 +41,15 @@
  and e, on the edge of the scale. If there is a letter l, which appears
  50 times, it will appear halfway between e and m, but displaced radially.
  Compare the differences between plaintext, random symbols, and ciphertext.
- Scale is adjusted automatically, to fit all symbols on a letter size page in
- the postscript output.
+
+ This is the live version, drawn with pygame. The file is counted a chunk
+ at a time in a background thread, and each symbol glides out to its new
+ radius as the counts come in. Only the parts of the screen that actually
+ changed get redrawn. Set SDL_VIDEODRIVER=dummy to run it headless.
+
+ It can also skip the window altogether and write the map out as a png
+ (or anything else pygame.image.save() knows), for one file or a whole
+ batch of them.
 """
 
 # Copyright: Jim Richardson, <weaselkeeper@gmail.com> 2012
@@ -56,15 +63,18 @@ Dec 29 2005, Rev 0.3: Rewrite a lot, including the rect-polar
 Dec 30 2005, Rev 0.4: Fix div/0 error for datasets that don't use all
 symbols available in good_symbols.
 May 06 2014, Rev 0.5 Starting to add option to display results w/pygame lib.
+Oct 18 2026, Rev 0.6 Live viewer, counting in the background and only
+                     redrawing what moved. Counting and layout now come
+                     from textmap.py rather than a copy of it.
+                     Offscreen png export from a pre-rendered glyph atlas.
 
 
 """
 PROJECTNAME = 'textmap'
 
 import sys
-import math
-import string
-from operator import itemgetter
+import threading
+import time
 import logging
 # Setup logging
 logging.basicConfig(level=logging.WARN,
@@ -80,12 +90,22 @@ log = logging.getLogger(PROJECTNAME)
 try:
     import pygame
 except ImportError as Err:
-    log.warn("failed to load pygame due to %s", Err)
+    log.warning("failed to load pygame due to %s", Err)
     sys.exit(1)
 
+import textmap
 
 # Setting some constants
-good_symbols = string.digits + string.letters
+FPS = 60
+WIDTH = 600
+HEIGHT = 600
+BLACK = (0, 0, 0)
+WHITE = (255, 255, 255)
+RED = (255, 0, 0)
+CYAN = (0, 255, 255)
+# Fraction of the remaining distance a glyph covers each frame.
+EASE = 0.2
+FONT_SIZE = 20
 
 
 def get_options():
@@ -96,234 +116,311 @@ def get_options():
         description='This is a data visualization aide.')
     parser.add_argument('-f', '--file', action='store', default=None,
         help='Input file', dest='inputfile')
-    parser.add_argument('-o', '--output', action='store', default='output.ps',
-        help='output file')
     parser.add_argument('-d', '--debug', action='store_true',
         help='enable debugging')
+    parser.add_argument('--fps', action='store', type=int, default=FPS,
+        help='frames per second to hold')
+    parser.add_argument('--size', action='store', default='%dx%d' %
+        (WIDTH, HEIGHT), help='window size, WIDTHxHEIGHT')
+    parser.add_argument('--chunk-size', action='store',
+        type=textmap.parse_size, default=64 * 1024,
+        help='bytes counted between updates')
+    parser.add_argument('--delay', action='store', type=float, default=0.0,
+        help='seconds to pause between chunks, to watch it slowly')
+    parser.add_argument('--frames', action='store', type=int, default=None,
+        help='quit after this many frames')
+    parser.add_argument('--exit', action='store_true',
+        help='quit once counting is done and everything has settled')
+    parser.add_argument('-o', '--output', action='store', default=None,
+        help='no window, just save the map to this image file')
+    parser.add_argument('-b', '--batch', action='store', nargs='+',
+        default=[], metavar='FILE',
+        help='save a map image for each of these files')
+    parser.add_argument('--output-template', action='store',
+        default='{stem}.png',
+        help='image name for batch inputs, from {name}, {stem}, {dir} and '
+        '{index}')
     _args = parser.parse_args()
-    _args.usage = PROJECTNAME + ".py [options]"
+    _args.usage = PROJECTNAME + "-canvas.py [options]"
     log.debug('leaving get_options')
     return _args
 
 
-def get_biggest(_dict):
-    """ calculate the largest offset, and divide all offsets by one tenth
-     of it, in order to get a 0 to 10 spread so that all the files run
-     through this will be in roughly the same scale. """
-    log.debug('in get_biggest')
-    _list = []
-    for item in _dict.keys():
-        _list.append(_dict[item])
-    _list.sort()
-
-    temp = [_list.pop(0) * -1, _list.pop()]
-    temp.sort()
-    log.debug('leaving get_biggest')
-    return temp.pop()
-
-
-def build_list(dataset):
-    """ Pass this a string or tuple of characters, get back a dict, of
-    char:number where number is the number of times that char occurs in
-    the dataset
-
-    We chop off cr/lf, and
-    whitespace. In fact, anything other than numerical, alphabetical are
-    pulled. All we care about are the actual symbols.  See good_symbols
-    for details on what we want to play with. Adjust accordingly.
-
-    First, we strip out bad_symbols, which are anything not in
-    good_symbols. Then we fill a dict with everything from plaintext that
-    is also present in good symbols, and set the value to 0 to start the
-    ball rolling. If you change good_symbols, be wary of stuff like \
-    which are postscript operators and must be dealt with or your output
-    will not be correct."""
-    log.debug('in build_list')
-    symbol_count = {}
-
-    for symbol in good_symbols:
-        symbol_count[symbol] = 0
-
-    for symbol in dataset:
-        if good_symbols.count(symbol):
-            symbol_count[symbol] = symbol_count.get(symbol, [0]) + 1
-    log.debug('leaving build_list')
-    return symbol_count
-
-
-def build_coords(symbol_dict, char_sep):
-    """ Create a list of the coords for the charmap"""
-    log.debug('in build_coords')
-    sorted_list = sorted(symbol_dict.items(), key=itemgetter(0))
-    angle = 0
-    R_coords = {}
-    P_coords = {}
-    biggest = 0
-    for char in symbol_dict.keys():
-        freq = symbol_dict[char]
-        if biggest < freq:
-            biggest = freq
-        if biggest:
-            scale_factor = 100.0 / biggest
-    log.debug("Final scale factor is %s and biggest is %s", scale_factor,
-              biggest)
-    for char in sorted_list:
-        freq_scaled = symbol_dict[char[0]] * scale_factor
-        P_coords[char[0]] = [angle, freq]
-        R_coords[char[0]] = [radme(angle, 'cos') * freq_scaled,
-                             radme(angle, 'sin') * freq_scaled]
-        angle = angle + char_sep
-    log.debug('leaving build_coords')
-    return R_coords
-
-
-def open_file(filename):
-    """ Should really break this up, and not gulp entire file at once. But
-    for now, will leave the read() alone.  """
-    log.debug('in open_file')
-    _input = open(filename)
-
-    data = _input.read()
-    data = string.strip(data)
-    _input.close()
-    #size = len(data)
-    log.debug('leaving open_file')
-    return data
-
-
-def massage(data):
-    """ Pass the data, one big string, to build_list, get a dict back."""
-    log.debug('in massage')
-    symbols_used = build_list(data)
-    size = len(symbols_used.keys())
-    char_sep = 360.0 / size  # Deg seperation between symbols on chart.
-
-# The Postscript stuff. Hand off the data, and the xy coords to be
-# written into the postscript file.
-
-    rect_coords = build_coords(symbols_used, char_sep)
-    build_postscript(rect_coords)
-
-# Supporting functions.
-    log.debug('leaving massage')
-
-
-def radme(deg, func):
-    """need degrees for the postscript stuff, python mathlib deals with
-    radians of course. """
-    if func == 'cos':
-        deg_real = math.cos(deg * math.pi / 180)
-    if func == 'sin':
-        deg_real = math.sin(deg * math.pi / 180)
-    return deg_real
-
-
-def build_postscript(rect_coords):
-    """ We have to take the frequency of symbol use value in symbol_dict, and
- convert that first to a polar radius value, (using char_sep, and
- incrementing it for the angle) then convert that polar coord pair,
- into rect coords for postscript. """
-    log.debug('in build_postscript')
-    output_file = args.output
-    output = open(output_file, 'w')
-
-#  Build the postscript file, which for now, appears on stdout.
-    output.write(header())
-    output.write(crosshair())
-    for sym in rect_coords.keys():
-        X, Y = rect_coords[sym]
-        log.debug("X and Y are %3.8f and %3.8f", X, Y)
-        if X and Y != 0.00000000:
-            output.write('%3.8f cal  %3.8f cal moveto (%s) show' % (X, Y, sym))
+def background(size):
+    """ The reticule, drawn once and kept, dirty rects are patched from it.
+    Same circle and crosshair as the postscript version. """
+    log.debug('in background')
+    width, height = size
+    surface = pygame.Surface(size)
+    surface.fill(BLACK)
+    center = (width // 2, height // 2)
+    radius = plot_radius(size)
+    pygame.draw.circle(surface, RED, center, radius, 1)
+    pygame.draw.line(surface, CYAN, (center[0] - radius, center[1]),
+                     (center[0] + radius, center[1]))
+    pygame.draw.line(surface, CYAN, (center[0], center[1] - radius),
+                     (center[0], center[1] + radius))
+    log.debug('leaving background')
+    return surface
+
+
+def plot_radius(size):
+    """ Screen radius of the outer edge of the map. """
+    return min(size) // 2 - 20
+
+
+def to_screen(coord, size):
+    """ build_coords() gives x, y in +-100, scale that to the window, with
+    y going up like it does in postscript. """
+    radius = plot_radius(size)
+    return (size[0] / 2.0 + coord[0] * radius / 100.0,
+            size[1] / 2.0 - coord[1] * radius / 100.0)
+
+
+class GlyphAtlas(object):
+    """ Every symbol rendered once, side by side on a single surface, with
+    the rect each one lives at. Drawing a symbol is then just a blit of
+    that area, no font rendering per map. """
+
+    def __init__(self, alphabet=textmap.good_symbols, size=FONT_SIZE,
+                 color=WHITE):
+        log.debug('in GlyphAtlas')
+        if not pygame.font.get_init():
+            pygame.font.init()
+        font = pygame.font.Font(None, size)
+        rendered = [(symbol, font.render(symbol, True, color))
+                    for symbol in alphabet]
+        width = sum(surface.get_width() for _symbol, surface in rendered)
+        height = max(surface.get_height() for _symbol, surface in rendered)
+        self.surface = pygame.Surface((width, height), pygame.SRCALPHA)
+        self.rects = {}
+        x = 0
+        for symbol, surface in rendered:
+            self.rects[symbol] = self.surface.blit(surface, (x, 0))
+            x += surface.get_width()
+        log.debug('leaving GlyphAtlas')
+
+    def glyph(self, symbol):
+        """ The symbol's bit of the atlas, as a subsurface (no copy). """
+        return self.surface.subsurface(self.rects[symbol])
+
+    def blit(self, target, symbol, center):
+        """ Draw symbol onto target, centered on center. Returns the rect
+        it covered. """
+        area = self.rects[symbol]
+        rect = area.copy()
+        rect.center = center
+        return target.blit(self.surface, rect, area)
+
+
+class RasterMap(object):
+    """ Offscreen renderer. The atlas and the reticule are built once, so
+    rendering a map is a copy of the background plus one blit per symbol,
+    and a batch of files shares all of the setup. """
+
+    def __init__(self, size=(WIDTH, HEIGHT), atlas=None):
+        self.size = size
+        self.atlas = atlas or GlyphAtlas()
+        self.background = background(size)
+
+    def render(self, symbols_used):
+        """ Surface with the map for a textmap.Histogram or char:number
+        dict. Symbols that never turned up are left off, as in the
+        postscript. """
+        if isinstance(symbols_used, textmap.Histogram):
+            symbols_used = symbols_used.as_dict()
+        surface = self.background.copy()
+        coords = textmap.coordinates(symbols_used)
+        for symbol, count in symbols_used.items():
+            if count:
+                x, y = to_screen(coords[symbol], self.size)
+                self.atlas.blit(surface, symbol,
+                                (int(round(x)), int(round(y))))
+        return surface
+
+    def save(self, symbols_used, output):
+        """ Render and write the image, format from output's extension. """
+        pygame.image.save(self.render(symbols_used), output)
+
+
+def export(inputs, template=None, output=None, size=(WIDTH, HEIGHT)):
+    """ Write an image for each of inputs, to output if there's just the
+    one, or else to names filled in from template. One RasterMap does them
+    all. Returns the number that failed. """
+    log.debug('in export')
+    raster = RasterMap(size)
+    failed = 0
+    for index, filename in enumerate(inputs):
+        if output is not None:
+            target = output
         else:
-            log.debug("zero count for symbol %s", sym)
-    output.write(' showpage \r')
-    output.close()
-    log.debug('leaving build_postscript')
-
-
-def crosshair():
-    """ Create the crosshair reticule for the display """
-    log.debug('in crosshair')
-    target = """
-        /crosshair {
-                gsave
-                newpath
-                /Radius 2 def
-                % Draw circle around 0 0
-                0 0 Radius 72 mul 0 360 arc stroke
-
-                0 cal   1 cal  moveto
-                0 cal -1 cal lineto
-                1  cal 0 cal moveto
-                -1 cal  0 cal  lineto
-                stroke
-                grestore
-                } def
-        crosshair """
-    log.debug('leaving crosshair')
-    return target
-
-
-def header():
-    """ Build the postscript header"""
-    log.debug('in header')
-    ps_header = """%!PS-Adobe-3.0
-%%DocumentData: Clean7Bit
-%%Orientation: Portrait
-%%Pages: 1
-%%PageOrder: Ascend
-%%Title: PackingList
-%%EndComments
-/cm {25.4 mul} def
-/cal {250 mul} def
-/Times-Roman findfont 12 scalefont setfont
-10 cm 15 cm translate
-"""
-    log.debug('leaving header')
-    return ps_header
-
-
-def drawCanvas():
-    """ Draw the canvas, what else?"""
-    FPS = 200
-    LINE = 10
-    WIDTH = 400
-    HEIGHT = 300
-    BLACK = (0, 0, 0)
-    WHITE = (255, 255, 255)
-    RED = (255, 0, 0 )
-    YELLOW = (255, 255, 0)
-    CYAN = (0, 255, 255)
-    MAGENTA = (255, 0, 255)
-    done = False
-    Canvas = pygame.display.set_mode(WIDTH, HEIGHT)
-    Canvas.fill((0, 0, 0))
-    RADIUS = 100
-    #Draw outline of arena
-    pygame.draw.rect(Canvas, WHITE, ((0, 0), (WIDTH, HEIGHT)), 0)
-    pygame.draw.rect(Canvas, CYAN, ((0, 0), (WIDTH/2, HEIGHT/2)), 0)
-    pygame.draw.rect(Canvas, MAGENTA, ((WIDTH/2, HEIGHT/2), (WIDTH/2, HEIGHT/2)), 0)
-    pygame.draw.circle(Canvas, YELLOW, (WIDTH/2, HEIGHT/2), RADIUS, 0)
-    while RADIUS >= 10:
-        pygame.draw.circle(Canvas, RED, (WIDTH/2, HEIGHT/2), RADIUS, 5)
-        RADIUS = RADIUS - 20
-
-
-def run():
-    """ The run() function, start here, note, there are no relevant args yet"""
+            target = textmap.output_name(template, filename, index)
+        try:
+            raster.save(textmap.Histogram.from_file(filename), target)
+        except (EnvironmentError, pygame.error) as Err:
+            log.warning('could not map %s, %s', filename, Err)
+            failed += 1
+    log.debug('leaving export')
+    return failed
+
+
+class Glyph(object):
+    """ One symbol on screen, where it is, where it's headed, and the rect
+    it was last drawn in. """
+
+    def __init__(self, symbol, surface, pos):
+        self.symbol = symbol
+        self.surface = surface
+        self.pos = pos
+        self.target = pos
+        self.rect = self.place()
+
+    def place(self):
+        """ Rect for the glyph centered on its current position. """
+        rect = self.surface.get_rect()
+        rect.center = (int(round(self.pos[0])), int(round(self.pos[1])))
+        return rect
+
+    def step(self):
+        """ Move part way to the target. Returns the old and new rects if
+        that moved it on screen, None otherwise. """
+        x, y = self.pos
+        tx, ty = self.target
+        if abs(tx - x) < 0.5 and abs(ty - y) < 0.5:
+            self.pos = self.target
+        else:
+            self.pos = (x + (tx - x) * EASE, y + (ty - y) * EASE)
+        rect = self.place()
+        if rect == self.rect:
+            return None
+        old, self.rect = self.rect, rect
+        return old, rect
+
+
+class Viewer(object):
+    """ Keeps the screen in step with a textmap.Histogram that some other
+    thread is busy filling in. """
+
+    def __init__(self, screen, histogram):
+        self.screen = screen
+        self.histogram = histogram
+        self.size = screen.get_size()
+        self.background = background(self.size)
+        atlas = GlyphAtlas(histogram.alphabet)
+        center = (self.size[0] / 2.0, self.size[1] / 2.0)
+        self.glyphs = [Glyph(symbol, atlas.glyph(symbol), center)
+                       for symbol in histogram.alphabet]
+        self.screen.blit(self.background, (0, 0))
+        pygame.display.flip()
+
+    def retarget(self):
+        """ Point every glyph at where the counts so far say it belongs. """
+        coords = textmap.coordinates(self.histogram)
+        for glyph in self.glyphs:
+            glyph.target = to_screen(coords[glyph.symbol], self.size)
+
+    def settled(self):
+        """ True once nothing is still on its way somewhere. """
+        return all(glyph.pos == glyph.target for glyph in self.glyphs)
+
+    def frame(self):
+        """ Move everything a step and redraw only what changed. Returns
+        the dirty rects handed to the display. """
+        dirty = []
+        for glyph in self.glyphs:
+            moved = glyph.step()
+            if moved:
+                dirty.extend(moved)
+        if not dirty:
+            return dirty
+        for rect in dirty:
+            self.screen.blit(self.background, rect, rect)
+        # Anything overlapping a patched rect lost some pixels, redraw it.
+        for glyph in self.glyphs:
+            if glyph.rect.collidelist(dirty) != -1:
+                self.screen.blit(glyph.surface, glyph.rect)
+        pygame.display.update(dirty)
+        return dirty
+
+
+def count_in_background(filename, histogram, chunk_size, delay=0.0):
+    """ Feed filename into histogram a chunk at a time from a daemon thread.
+    Returns the thread and an Event that is set when it has finished. """
+    done = threading.Event()
+
+    def counter():
+        try:
+            for chunk in textmap.open_file(filename, chunk_size=chunk_size):
+                histogram.update(chunk)
+                if delay:
+                    time.sleep(delay)
+        except EnvironmentError as Err:
+            log.warning('could not read %s, %s', filename, Err)
+        finally:
+            done.set()
+
+    thread = threading.Thread(target=counter, name='counter')
+    thread.daemon = True
+    thread.start()
+    return thread, done
+
+
+def drawCanvas(filename, size=(WIDTH, HEIGHT), fps=FPS, chunk_size=65536,
+               delay=0.0, frames=None, exit_when_done=False):
+    """ Draw the canvas, what else? Runs until the window is closed, or
+    for frames frames, or (with exit_when_done) until the counting has
+    finished and every glyph has come to rest. Returns the histogram. """
+    log.debug('in drawCanvas')
+    pygame.init()
+    screen = pygame.display.set_mode(size)
+    pygame.display.set_caption('%s - %s' % (PROJECTNAME, filename))
+    histogram = textmap.Histogram()
+    viewer = Viewer(screen, histogram)
+    _thread, done = count_in_background(filename, histogram, chunk_size,
+                                        delay)
+    clock = pygame.time.Clock()
+    count = 0
+    running = True
+    while running:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+        finished = done.is_set()
+        viewer.retarget()
+        viewer.frame()
+        clock.tick(fps)
+        count += 1
+        if frames is not None and count >= frames:
+            running = False
+        if exit_when_done and finished and viewer.settled():
+            running = False
+    log.debug('%d frames, %.1f fps at the end', count, clock.get_fps())
+    pygame.quit()
+    log.debug('leaving drawCanvas')
+    return histogram
+
+
+def run(args):
+    """ The run() function, start here """
     log.debug('in run')
-    if args.inputfile:
-        name = args.inputfile
-    else:
-        # No filename given, ask for one. Note buffer overrun
-        # possibility. Also, this takes pathname as part of filename,
-        # bigtime doubleplusungood
-        name = str(raw_input(' need a filename please! : '))
-
-    data = open_file(name)
-    massage(data)
+    width, height = [int(part) for part in args.size.lower().split('x')]
+    if args.batch:
+        failed = export(args.batch, template=args.output_template,
+                        size=(width, height))
+        log.debug('leaving run')
+        return 1 if failed else 0
+    if not args.inputfile:
+        log.error('need a filename please, -f <file>')
+        return 1
+    if args.output:
+        failed = export([args.inputfile], output=args.output,
+                        size=(width, height))
+        log.debug('leaving run')
+        return 1 if failed else 0
+    drawCanvas(args.inputfile, (width, height), args.fps, args.chunk_size,
+               args.delay, args.frames, args.exit)
     log.debug('leaving run')
+    return 0
 
 
 if __name__ == "__main__":
@@ -337,4 +434,4 @@ if __name__ == "__main__":
     else:
         log.setLevel(logging.WARN)
 
-    sys.exit(run())
+    sys.exit(run(args))
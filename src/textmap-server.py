@@ -0,0 +1,350 @@
+#!/usr/bin/env  python
+###
+# Copyright (c) 2006, Jim Richardson <weaselkeeper@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+
+ Render daemon for textmap. Keeps a pool of warm worker processes and
+ answers over plain HTTP, on localhost or a unix socket, so a caller pays
+ for a request rather than a whole interpreter start up.
+
+   POST /render?path=/some/file    map of a file the daemon can read
+   POST /render                    map of the request body
+   GET  /stats                     queue depth, cache and latency numbers
+
+ Maps come back as postscript. Repeat requests for a file that hasn't
+ changed (same path, size and mtime) or for the same uploaded bytes are
+ answered from an LRU cache without touching the pool, and identical
+ requests that arrive together share one render. Needs python 3 (asyncio).
+
+ e.g.
+   ./textmap-server.py --socket /tmp/textmap.sock &
+   curl --unix-socket /tmp/textmap.sock -X POST \
+        'http://localhost/render?path=/var/tmp/capture.bin' > capture.ps
+"""
+
+PROJECTNAME = 'textmap'
+
+import sys
+import os
+import json
+import time
+import signal
+import asyncio
+import hashlib
+import collections
+import concurrent.futures
+from urllib.parse import urlsplit, parse_qs
+import logging
+# Setup logging
+logging.basicConfig(level=logging.WARN,
+                    format='%(asctime)s %(levelname)s - %(message)s',
+                    datefmt='%y.%m.%d %H:%M:%S')
+log = logging.getLogger(PROJECTNAME)
+
+import textmap
+
+# Setting some constants
+PORT = 8086
+CACHE_ENTRIES = 256
+MAX_QUEUE = 1024
+MAX_UPLOAD = 1024 * 1024 * 1024
+# Latencies kept for the percentiles in /stats.
+LATENCY_WINDOW = 1000
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+def get_options():
+    """ Parse for any options """
+    log.debug('in get_options')
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Render daemon for textmap.')
+    parser.add_argument('-s', '--socket', action='store', default=None,
+                        help='listen on this unix socket rather than tcp')
+    parser.add_argument('-p', '--port', action='store', type=int,
+                        default=PORT, help='localhost port to listen on')
+    parser.add_argument('-j', '--jobs', action='store', type=int,
+                        default=None,
+                        help='worker processes, defaults to one per cpu')
+    parser.add_argument('--cache-entries', action='store', type=int,
+                        default=CACHE_ENTRIES,
+                        help='rendered maps kept for repeat requests')
+    parser.add_argument('--max-queue', action='store', type=int,
+                        default=MAX_QUEUE,
+                        help='renders allowed to wait before new ones are '
+                        'turned away with a 503')
+    parser.add_argument('--backend', action='store', default='auto',
+                        choices=['auto', 'numpy', 'python'],
+                        help='symbol counting backend for the workers')
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help='enable debugging')
+    _args = parser.parse_args()
+    _args.usage = PROJECTNAME + "-server.py [options]"
+    log.debug('leaving get_options')
+    return _args
+
+
+class HTTPError(Exception):
+    """ Turned into an error response with this status. """
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def _worker_init(backend, level):
+    """ Runs once in each worker process. """
+    textmap.set_backend(backend)
+    log.setLevel(level)
+
+
+class RenderServer(object):
+    """ The daemon's state, the worker pool, the result cache, the renders
+    in flight and the numbers reported by /stats. Everything here is only
+    touched from the event loop thread. """
+
+    def __init__(self, jobs=None, cache_entries=CACHE_ENTRIES,
+                 max_queue=MAX_QUEUE, backend='auto'):
+        self.jobs = jobs or textmap.default_jobs()
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            self.jobs, initializer=_worker_init,
+            initargs=(backend, log.getEffectiveLevel()))
+        self.cache = collections.OrderedDict()
+        self.cache_entries = cache_entries
+        self.max_queue = max_queue
+        self.inflight = {}
+        self.started = time.time()
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.counts = collections.Counter()
+
+    def close(self):
+        self.pool.shutdown()
+
+    def _cached(self, key):
+        result = self.cache.get(key)
+        if result is not None:
+            self.cache.move_to_end(key)
+        return result
+
+    def _remember(self, key, result):
+        self.cache[key] = result
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_entries:
+            self.cache.popitem(last=False)
+
+    async def render(self, key, func, *args):
+        """ The map for key, from the cache, from a render of the same key
+        already under way, or from func(*args) run in the pool. """
+        result = self._cached(key)
+        if result is not None:
+            self.counts['cache_hits'] += 1
+            return result
+        self.counts['cache_misses'] += 1
+        future = self.inflight.get(key)
+        if future is None:
+            if len(self.inflight) >= self.max_queue:
+                raise HTTPError(503, 'render queue is full')
+            loop = asyncio.get_event_loop()
+            future = loop.run_in_executor(self.pool, func, *args)
+            self.inflight[key] = future
+            try:
+                result = await future
+            finally:
+                del self.inflight[key]
+            self._remember(key, result)
+            return result
+        self.counts['coalesced'] += 1
+        return await asyncio.shield(future)
+
+    async def render_path(self, path):
+        """ Map of a file on disk. Keyed on its identity, so an unchanged
+        file is only ever rendered once. """
+        if not os.path.isabs(path):
+            raise HTTPError(400, 'path must be absolute')
+        try:
+            info = os.stat(path)
+        except FileNotFoundError:
+            raise HTTPError(404, 'no such file %s' % path)
+        except OSError as Err:
+            raise HTTPError(400, str(Err))
+        key = ('path', os.path.realpath(path), info.st_size,
+               info.st_mtime_ns)
+        return await self.render(key, textmap.render_file, path)
+
+    async def render_upload(self, data):
+        """ Map of bytes sent in the request. """
+        key = ('data', hashlib.sha1(data).hexdigest(), len(data))
+        return await self.render(key, textmap.render_data, data)
+
+    def stats(self):
+        """ Queue depth, cache and latency figures, for /stats. """
+        latencies = sorted(self.latencies)
+
+        def percentile(fraction):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1,
+                                 int(fraction * len(latencies)))] * 1000.0
+        return {'uptime': time.time() - self.started,
+                'workers': self.jobs,
+                'queue_depth': len(self.inflight),
+                'cached': len(self.cache),
+                'requests': self.counts['requests'],
+                'errors': self.counts['errors'],
+                'cache_hits': self.counts['cache_hits'],
+                'cache_misses': self.counts['cache_misses'],
+                'coalesced': self.counts['coalesced'],
+                'latency_ms': {'p50': percentile(0.5),
+                               'p95': percentile(0.95),
+                               'p99': percentile(0.99),
+                               'max': percentile(1.0)}}
+
+    async def dispatch(self, method, target, body):
+        """ Route one request, returns (content type, body bytes). """
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        if url.path == '/stats':
+            return ('application/json',
+                    json.dumps(self.stats(), sort_keys=True).encode('ascii'))
+        if url.path != '/render':
+            raise HTTPError(404, 'no such endpoint %s' % url.path)
+        if method != 'POST':
+            raise HTTPError(405, 'use POST for /render')
+        if 'path' in query:
+            page = await self.render_path(query['path'][0])
+        else:
+            page = await self.render_upload(body)
+        return 'application/postscript', page.encode('ascii')
+
+    async def handle(self, reader, writer):
+        """ One connection, one request, then close. """
+        started = time.time()
+        self.counts['requests'] += 1
+        status, content_type, payload = 200, 'text/plain', b''
+        try:
+            method, target, body = await read_request(reader)
+            content_type, payload = await self.dispatch(method, target, body)
+        except HTTPError as Err:
+            status, payload = Err.status, (str(Err) + '\n').encode('utf-8')
+        except Exception as Err:
+            log.exception('render failed')
+            status, payload = 500, ('%s\n' % Err).encode('utf-8')
+        if status != 200:
+            self.counts['errors'] += 1
+        try:
+            writer.write(('HTTP/1.1 %d %s\r\nContent-Type: %s\r\n'
+                          'Content-Length: %d\r\nConnection: close\r\n\r\n' %
+                          (status, REASONS.get(status, ''), content_type,
+                           len(payload))).encode('ascii'))
+            writer.write(payload)
+            await writer.drain()
+        except ConnectionError:
+            log.debug('client went away')
+        finally:
+            writer.close()
+        self.latencies.append(time.time() - started)
+
+
+async def read_request(reader):
+    """ Just enough HTTP/1.1 to get the method, target and body. """
+    line = await reader.readline()
+    try:
+        method, target, _version = line.decode('latin-1').split()
+    except ValueError:
+        raise HTTPError(400, 'bad request line')
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _sep, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            value = value.strip()
+            if not (value.isascii() and value.isdigit()):
+                raise HTTPError(400, 'bad content-length %r' % value)
+            length = int(value)
+    if length > MAX_UPLOAD:
+        raise HTTPError(413, 'upload too big')
+    body = await reader.readexactly(length) if length else b''
+    return method.upper(), target, body
+
+
+async def serve(server, socket_path=None, port=PORT):
+    """ Listen until cancelled. """
+    if socket_path:
+        listener = await asyncio.start_unix_server(server.handle,
+                                                   path=socket_path)
+        log.warning('listening on %s', socket_path)
+    else:
+        listener = await asyncio.start_server(server.handle, '127.0.0.1',
+                                              port)
+        log.warning('listening on 127.0.0.1:%d', port)
+    async with listener:
+        await listener.serve_forever()
+
+
+def _terminate(signum, frame):
+    """ SIGTERM shuts down the same way ctrl-c does. """
+    raise KeyboardInterrupt
+
+
+def run(args):
+    """ The run() function, start here """
+    log.debug('in run')
+    signal.signal(signal.SIGTERM, _terminate)
+    server = RenderServer(args.jobs, args.cache_entries, args.max_queue,
+                          args.backend)
+    try:
+        asyncio.run(serve(server, args.socket, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+    log.debug('leaving run')
+    return 0
+
+
+if __name__ == "__main__":
+    # This is where we will begin when called from CLI. No need for argparse
+    # unless being called interactively, so import it here, or at least, in
+    # get_options
+    args = get_options()
+
+    if args.debug:
+        log.setLevel(logging.DEBUG)
+    else:
+        log.setLevel(logging.WARN)
+
+    sys.exit(run(args))
@@ -32,8 +32,9 @@
 """
 
  This is a data visualization aide. It takes a filename  (Contents
- of file should be 8 bit ascii only please), and calculates the relative
- frequency of each symbol, then graphically represents how often the
+ of file should be 8 bit ascii only please, or utf-8 with --utf8), and
+ calculates the relative frequency of each symbol, then graphically
+ represents how often the
  symbol appears in the text, by placing each symbol from the text, in
  a circle, the distance from the center, being related to how frequent
  the symbol occurs. So if you have text, which consists of only the
@@ -43,29 +44,242 @@
  Compare the differences between plaintext, random symbols, and ciphertext.
  Scale is adjusted automatically, to fit all symbols on a letter size page in
  the postscript output.
+
+ It can be imported too, Histogram.from_file() (or Histogram().update()
+ with your own data) counts, coordinates() lays out, and draw_map() renders
+ to a path or file like object. Nothing in there touches the command line.
 """
 
 # Copyright: Jim Richardson, <weaselkeeper@gmail.com> 2012
 
 PROJECTNAME = 'textmap'
 
+# Only the cheap stdlib modules are imported up front, so that importing
+# this as a library costs next to nothing. The heavier ones (argparse,
+# multiprocessing, tempfile, json, hashlib, numpy) are imported where they
+# are used.
 import sys
+import errno
+import contextlib
+import itertools
 import math
+import mmap
+import signal
+import os
 import string
+import stat
+import struct
+import threading
+import time
+from collections import Counter
 from operator import itemgetter
 import logging
-# Setup logging
-logging.basicConfig(level=logging.WARN,
-                    format='%(asctime)s %(levelname)s - %(message)s',
-                    datefmt='%y.%m.%d %H:%M:%S')
-
-# Setup logging to console.
-console = logging.StreamHandler(sys.stderr)
-console.setLevel(logging.WARN)
-logging.getLogger(PROJECTNAME).addHandler(console)
 log = logging.getLogger(PROJECTNAME)
+
+# resource only exists on unix, without it peak memory isn't reported.
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# numpy is optional, it just makes the counting a lot faster. Without it we
+# fall back to the pure python counter, which gets the same answer. It is
+# slow to import, so that waits until have_numpy() is first asked.
+numpy = None
+_numpy_missing = False
 # Setting some constants
-good_symbols = string.digits + string.letters
+good_symbols = string.digits + string.ascii_letters
+DEFAULT_OUTPUT = 'output.ps'
+# Output names for batch inputs and --sweep windows, see output_name().
+BATCH_TEMPLATE = '{stem}.ps'
+SWEEP_TEMPLATE = '{stem}-{start}.ps'
+# How much of the input we hold in memory at any one time.
+CHUNK_SIZE = 1024 * 1024
+# Files smaller than this are counted in process, spinning up workers for
+# them costs more than it saves.
+PARALLEL_THRESHOLD = 64 * 1024 * 1024
+# Bumped whenever the cached histogram format or counting rules change.
+CACHE_VERSION = 1
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                         os.path.join(os.path.expanduser('~'), '.cache'),
+                         PROJECTNAME)
+CACHE_LIMIT = 64 * 1024 * 1024
+# The cache is only trimmed on the first put in a process and every
+# CACHE_TRIM_EVERY after, going over the whole directory on every miss
+# gets slow once it has tens of thousands of entries in it.
+CACHE_TRIM_EVERY = 256
+_cache_puts = 0
+# Bytes per batch of blocks for the entropy scan (fewer for blocks under
+# 256 bytes, whose 256 counters each outweigh the block), and the most cells
+# the heatmap will draw before it starts putting several blocks in each one.
+ENTROPY_BATCH = 1024 * 1024
+HEATMAP_CELLS = 256 * 256
+# Letter paper in points, the margin round it and the size of the titles
+# under each map, for the many page documents from build_document().
+PAGE_WIDTH = 612
+PAGE_HEIGHT = 792
+PAGE_MARGIN = 18
+TITLE_SIZE = 8
+# translate() table blanking every ascii byte to a space, after which
+# split() hands back just the runs of non ascii bytes, see SymbolCounter.
+_ASCII_BLANK = bytes(bytearray(32 if value < 128 else value
+                               for value in range(256)))
+# Count-min sketch files, see NgramSketch.save(). Header, then the tracked
+# top n-grams as 64 bit keys, then the depth x width table of counters.
+SKETCH_MAGIC = b'TMCS'
+SKETCH_VERSION = 1
+SKETCH_MEMORY = 16 * 1024 * 1024
+_SKETCH_HEADER = struct.Struct('<4sHBBIIQQI')
+# Long scans save their progress to a checkpoint every CHECKPOINT_BYTES, or
+# CHECKPOINT_SECONDS, whichever comes first. See Checkpoint.
+CHECKPOINT_VERSION = 2
+CHECKPOINT_BYTES = 1024 * 1024 * 1024
+CHECKPOINT_SECONDS = 60
+# Block size for --sample, and the z for its 95% confidence intervals.
+# With fewer than 30 blocks the z is too narrow, those use the Student's t
+# for their degrees of freedom (blocks - 1) from SAMPLE_T instead.
+SAMPLE_BLOCK = 64 * 1024
+SAMPLE_Z = 1.96
+SAMPLE_T = (12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262,
+            2.228, 2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101,
+            2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052,
+            2.048, 2.045)
+# Leading bytes of the compressed formats we'll read through, and the
+# module that knows how.
+MAGIC = [(b'\x1f\x8b', 'gzip'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'lzma')]
+# Prefix sum index sidecar, see build_index().
+INDEX_SUFFIX = '.tmidx'
+INDEX_BLOCK = 64 * 1024
+INDEX_MAGIC = b'TMIX'
+INDEX_VERSION = 1
+_INDEX_HEADER = struct.Struct('<4sHIQQdH')
+# Binary histogram files, see save_histogram(). The header is followed by
+# the alphabet, the source name, padding out to 8 bytes and then one little
+# endian 64 bit counter per symbol.
+HIST_SUFFIX = '.tmh'
+HIST_MAGIC = b'TMHG'
+HIST_VERSION = 1
+_HIST_HEADER = struct.Struct('<4sHHI')
+_unicode_type = type(u'')
+try:
+    _string_types = (basestring, bytearray, buffer, memoryview)
+except NameError:
+    _string_types = (str, bytes, bytearray, memoryview)
+_izip = getattr(itertools, 'izip', zip)
+
+
+def _view(obj, offset, size):
+    """ A zero copy window onto obj, memoryview where the object supports
+    it, the old style buffer() otherwise (mmap on python 2). """
+    try:
+        return memoryview(obj)[offset:offset + size]
+    except TypeError:
+        return buffer(obj, offset, size)
+
+
+def setup_logging():
+    """ Console logging for when we're run as a script. Left alone when
+    imported, logging setup is the importer's business. """
+    logging.basicConfig(level=logging.WARN,
+                        format='%(asctime)s %(levelname)s - %(message)s',
+                        datefmt='%y.%m.%d %H:%M:%S')
+
+
+def have_numpy():
+    """ Import numpy the first time through, True if we've got it. """
+    global numpy, _numpy_missing
+    if numpy is None and not _numpy_missing:
+        try:
+            import numpy as _numpy
+        except ImportError:
+            _numpy_missing = True
+        else:
+            numpy = _numpy
+    return numpy is not None
+
+
+def peak_rss():
+    """ Peak resident set size of this process so far, in bytes, or None
+    where we can't tell. """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+
+class Metrics(object):
+    """ Running totals of wall time, bytes and calls for each stage of a
+    run (read, count, layout, render, write and so on), with the peak RSS
+    seen at the end of each. Recording is a couple of clock reads and one
+    getrusage() per call, cheap enough to leave on all the time. """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """ Start over, for a new run. """
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+
+    def add(self, name, seconds, size=0):
+        """ Book seconds and size bytes against stage name. """
+        peak = peak_rss()
+        with self._lock:
+            record = self.stages.get(name)
+            if record is None:
+                record = self.stages[name] = {'seconds': 0.0, 'bytes': 0,
+                                              'calls': 0, 'peak_rss': None}
+            record['seconds'] += seconds
+            record['bytes'] += size
+            record['calls'] += 1
+            record['peak_rss'] = peak
+
+    @contextlib.contextmanager
+    def stage(self, name, size=0):
+        """ with metrics.stage('layout'): ... times the block. """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - started, size)
+
+    def record(self, **extra):
+        """ Everything so far as one dict, ready for json. extra is merged
+        in at the top level. """
+        stages = {}
+        with self._lock:
+            records = [(name, dict(record))
+                       for name, record in self.stages.items()]
+        for name, record in records:
+            record['bytes_per_sec'] = (record['bytes'] / record['seconds']
+                                       if record['bytes'] and
+                                       record['seconds'] else None)
+            stages[name] = record
+        result = {'started': self.started,
+                  'seconds': time.time() - self.started,
+                  'peak_rss': peak_rss(), 'stages': stages}
+        result.update(extra)
+        return result
+
+    def report(self):
+        """ The stages as a small human readable table. """
+        lines = ['%-8s %10s %14s %12s %10s' % ('stage', 'seconds', 'bytes',
+                                               'MB/s', 'peak MB')]
+        for name, record in sorted(self.record()['stages'].items(),
+                                   key=lambda item: item[0]):
+            lines.append('%-8s %10.4f %14d %12s %10s' % (
+                name, record['seconds'], record['bytes'],
+                '%.1f' % (record['bytes_per_sec'] / 1e6)
+                if record['bytes'] and record['bytes_per_sec'] else '-',
+                '%.1f' % (record['peak_rss'] / 1e6)
+                if record['peak_rss'] else '-'))
+        return '\n'.join(lines) + '\n'
+
+# Stage timings for the current run, see Metrics.
+metrics = Metrics()
 
 
 def get_options():
@@ -75,12 +289,223 @@ def get_options():
     parser = argparse.ArgumentParser(
         description='This is a data visualization aide.')
     parser.add_argument('-f', '--file', action='store', default=None,
-                        help='Input file', dest='inputfile')
-    parser.add_argument('-o', '--output', action='store', default='output.ps',
+                        help='Input file, - for stdin, or a directory or glob '
+                        'to count everything in. gzip, bzip2 and xz are '
+                        'decompressed as they are read', dest='inputfile')
+    parser.add_argument('-o', '--output', action='store',
+                        default=DEFAULT_OUTPUT,
                         help='output file')
     parser.add_argument('-d', '--debug', action='store_true',
                         help='enable debugging')
+    parser.add_argument('--backend', action='store', default='auto',
+                        choices=['auto', 'numpy', 'python'],
+                        help='symbol counting backend, auto uses numpy if '
+                        'it is installed')
+    parser.add_argument('--no-mmap', action='store_false', dest='mmap',
+                        help='read the input with plain buffered reads '
+                        'instead of mapping it')
+    parser.add_argument('--raw', action='store_false', dest='decompress',
+                        help='count gzip, bzip2 and xz files as they are '
+                        'rather than decompressing them first')
+    parser.add_argument('-j', '--jobs', action='store', type=int,
+                        default=None,
+                        help='worker processes for counting big files, '
+                        'defaults to one per cpu')
+    parser.add_argument('-b', '--batch', action='store', nargs='+',
+                        default=[], metavar='FILE',
+                        help='render each of these files to its own output')
+    parser.add_argument('--batch-list', action='store', default=None,
+                        metavar='LISTING',
+                        help='file listing batch inputs, one path per line')
+    parser.add_argument('--output-template', action='store',
+                        default=None,
+                        help='output name for batch inputs, from {name}, '
+                        '{stem}, {dir} and {index}, default {stem}.ps '
+                        '({stem}-{start}.ps for --sweep, which also has '
+                        '{start} and {end})')
+    parser.add_argument('--combine', action='store_true',
+                        help='draw every batch input into the one '
+                        'document, --output, instead of a file each')
+    parser.add_argument('--per-page', action='store', type=int, default=1,
+                        metavar='N',
+                        help='with --combine, put N maps on each page as a '
+                        'grid of small multiples')
+    parser.add_argument('--timeout', action='store', type=float,
+                        default=None,
+                        help='seconds each batch input is allowed before '
+                        'it is given up on')
+    parser.add_argument('--include', action='append', default=[],
+                        metavar='PATTERN',
+                        help='with a directory or glob for -f, only count '
+                        'files whose names match PATTERN, may be repeated')
+    parser.add_argument('--exclude', action='append', default=[],
+                        metavar='PATTERN',
+                        help='skip files and directories whose names match '
+                        'PATTERN, may be repeated')
+    parser.add_argument('--follow-links', action='store_true',
+                        help='go into symlinked directories when walking a '
+                        'directory')
+    parser.add_argument('--per-file', action='store', default=None,
+                        metavar='TEMPLATE',
+                        help='also save each file\'s histogram, in the binary '
+                        'format, named from TEMPLATE like --output-template')
+    parser.add_argument('--progress', action='store_true',
+                        help='report files and bytes done as a directory or '
+                        'glob is counted')
+    parser.add_argument('--checkpoint', action='store', default=None,
+                        metavar='STATE',
+                        help='save the counts so far to STATE every so '
+                        'often, for --resume after a crash')
+    parser.add_argument('--checkpoint-every', action='store',
+                        type=parse_size, default=CHECKPOINT_BYTES,
+                        metavar='SIZE',
+                        help='bytes counted between checkpoints, 0 for no '
+                        'limit')
+    parser.add_argument('--checkpoint-seconds', action='store', type=float,
+                        default=CHECKPOINT_SECONDS, metavar='SECONDS',
+                        help='most seconds between checkpoints, 0 for no '
+                        'limit')
+    parser.add_argument('--resume', action='store_true',
+                        help='carry on from the last --checkpoint rather '
+                        'than starting over')
+    parser.add_argument('--compare', action='store', nargs='+', default=[],
+                        metavar='FILE',
+                        help='print entropy, index of coincidence, chi '
+                        'squared and the distances between these files '
+                        'instead of drawing anything')
+    parser.add_argument('--compare-list', action='store', default=None,
+                        metavar='LISTING',
+                        help='file listing inputs to compare, one path per '
+                        'line')
+    parser.add_argument('--reference', action='store', default=None,
+                        metavar='FILE',
+                        help='chi squared is against the symbol frequencies '
+                        'of FILE, rather than all symbols being equally '
+                        'likely')
+    parser.add_argument('--report', action='store', default='table',
+                        choices=['table', 'json'],
+                        help='how to print the comparison')
+    parser.add_argument('--emit', action='store', default=None,
+                        metavar='FILE',
+                        help='write the histogram to FILE in the binary '
+                        'format, - for stdout, instead of drawing it')
+    parser.add_argument('--merge', action='store', nargs='+', default=[],
+                        metavar='FILE',
+                        help='add up these binary histograms and draw (or '
+                        '--emit) the total')
+    parser.add_argument('--merge-list', action='store', default=None,
+                        metavar='LISTING',
+                        help='file listing histograms to merge, one path '
+                        'per line')
+    parser.add_argument('--sample', action='store', type=float, nargs='?',
+                        const=0.01, default=None, metavar='FRACTION',
+                        help='estimate the map from this fraction of the '
+                        'input (0.01 if not given) instead of reading all '
+                        'of it')
+    parser.add_argument('--sample-block', action='store', type=parse_size,
+                        default=SAMPLE_BLOCK, metavar='BYTES',
+                        help='size of each sampled block')
+    parser.add_argument('--sample-spread', action='store', default='random',
+                        choices=['random', 'even'],
+                        help='sample blocks at random or evenly spaced')
+    parser.add_argument('--seed', action='store', type=int, default=None,
+                        help='seed for picking random sample blocks')
+    parser.add_argument('--budget-time', action='store', type=float,
+                        default=None, metavar='SECONDS',
+                        help='stop sampling after this long')
+    parser.add_argument('--budget-bytes', action='store', type=parse_size,
+                        default=None, metavar='BYTES',
+                        help='stop sampling after reading this much')
+    parser.add_argument('-F', '--follow', action='store_true',
+                        help='keep watching the input as it grows, and '
+                        'redraw as new data comes in')
+    parser.add_argument('--interval', action='store', type=float,
+                        default=2.0,
+                        help='seconds between redraws in follow mode')
+    parser.add_argument('--every', action='store', type=int, default=None,
+                        metavar='BYTES',
+                        help='in follow mode, also redraw as soon as this '
+                        'many new bytes have come in')
+    parser.add_argument('--build-index', action='store_true',
+                        help='(re)build the prefix sum index next to the '
+                        'input')
+    parser.add_argument('--index-block', action='store', type=parse_size,
+                        default=INDEX_BLOCK, metavar='BYTES',
+                        help='bytes between rows of the prefix sum index')
+    parser.add_argument('--range', action='store', type=parse_range,
+                        default=None, metavar='START:END',
+                        help='only map this byte range of the input')
+    parser.add_argument('--sweep', action='store', default=None,
+                        metavar='WINDOW[:STEP]',
+                        help='map every WINDOW bytes, STEP bytes apart, to '
+                        'outputs named by --output-template')
+    parser.add_argument('--entropy', action='store', type=parse_size,
+                        default=None, metavar='BLOCK',
+                        help='draw the entropy of every BLOCK bytes of the '
+                        'input as a heatmap instead of the symbol map')
+    parser.add_argument('--entropy-dump', action='store', default=None,
+                        metavar='FILE',
+                        help='with --entropy, also write the entropies to '
+                        'FILE, a line per block or a .npy array')
+    parser.add_argument('-u', '--utf8', action='store_true',
+                        help='decode the input as utf-8 and map the letters '
+                        'and digits of every script, not just ascii')
+    parser.add_argument('-n', '--ngram', action='store', type=int,
+                        default=1, choices=[1, 2, 3],
+                        help='count runs of this many symbols, 2 draws a '
+                        'pair grid, 3 maps the --top most common triples')
+    parser.add_argument('--top', action='store', type=int, default=62,
+                        help='how many n-grams to put on the map')
+    parser.add_argument('--sketch', action='store', type=int, default=None,
+                        choices=range(1, 9), metavar='N',
+                        help='estimate the --top most common runs of N bytes '
+                        '(1 to 8, any byte values) in a fixed size count-min '
+                        'sketch, print them with error bounds and draw them')
+    parser.add_argument('--sketch-memory', action='store', type=parse_size,
+                        default=SKETCH_MEMORY, metavar='BYTES',
+                        help='how big the sketch table may be')
+    parser.add_argument('--sketch-depth', action='store', type=int,
+                        default=4,
+                        help='rows in the sketch, each one more makes the '
+                        'error bound e times less likely to be broken')
+    parser.add_argument('--save-sketch', action='store', default=None,
+                        metavar='FILE',
+                        help='write the sketch to FILE for merging later')
+    parser.add_argument('--merge-sketch', action='store', nargs='+',
+                        default=[], metavar='FILE',
+                        help='add up these saved sketches and report on (or '
+                        '--save-sketch) the total')
+    parser.add_argument('--profile', action='store_true',
+                        help='print wall time, bytes, throughput and peak '
+                        'memory for each stage when done')
+    parser.add_argument('--metrics-json', action='store', default=None,
+                        metavar='FILE',
+                        help='append the stage metrics for this run to FILE '
+                        'as one line of json, - for stdout')
+    parser.add_argument('--cprofile', action='store', default=None,
+                        metavar='FILE',
+                        help='run under cProfile and dump the stats to FILE')
+    parser.add_argument('--no-cache', action='store_false', dest='cache',
+                        help='always count the input, never use or fill the '
+                        'histogram cache')
+    parser.add_argument('--clear-cache', action='store_true',
+                        help='empty the histogram cache before starting')
+    parser.add_argument('--cache-dir', action='store', default=CACHE_DIR,
+                        help='where cached histograms live')
+    parser.add_argument('--cache-size', action='store', type=int,
+                        default=CACHE_LIMIT,
+                        help='bytes the cache may use before old entries '
+                        'are dropped')
+    parser.add_argument('--cache-hash', action='store_true',
+                        help='also key cache entries on a hash of the file '
+                        'contents')
     _args = parser.parse_args()
+    if _args.sample_block <= 0:
+        parser.error('--sample-block has to be more than 0 bytes')
+    if _args.top < 1:
+        parser.error('--top has to be at least 1')
+    if _args.sketch_depth < 1:
+        parser.error('--sketch-depth has to be at least 1')
     _args.usage = PROJECTNAME + ".py [options]"
     log.debug('leaving get_options')
     return _args
@@ -102,35 +527,687 @@ def get_biggest(_dict):
     return temp.pop()
 
 
+def new_histogram():
+    """ A fresh 256 entry table, one counter per possible byte value. """
+    return [0] * 256
+
+
+def _byte_table(alphabet):
+    """ Map each symbol in alphabet to its byte value, and the one byte
+    needle we hand to count(). Symbols that don't fit in a byte are left
+    out, they can't show up in a byte histogram anyway. """
+    table = _BYTE_TABLES.get(alphabet)
+    if table is None:
+        table = [(ord(sym), struct.pack('B', ord(sym)))
+                 for sym in alphabet if ord(sym) < 256]
+        _BYTE_TABLES[alphabet] = table
+    return table
+
+_BYTE_TABLES = {}
+
+
+def _as_bytes(chunk):
+    """ count() wants real bytes, so flatten text, buffers and views. Only
+    ever called on one chunk at a time. """
+    if isinstance(chunk, (bytes, bytearray)):
+        return chunk
+    if isinstance(chunk, _unicode_type):
+        return chunk.encode('latin-1', 'replace')
+    return bytes(chunk)
+
+
+def _count_chunk_python(chunk, histogram, alphabet):
+    """ One pass of count() per symbol, which keeps the per byte work down
+    in C. """
+    chunk = _as_bytes(chunk)
+    for value, needle in _byte_table(alphabet):
+        histogram[value] += chunk.count(needle)
+
+
+def _count_chunk_numpy(chunk, histogram, alphabet):
+    """ View the chunk as a uint8 array (no copy for bytes, buffers, views
+    or mmaps), bincount the lot, then mask it down to alphabet. """
+    if isinstance(chunk, _unicode_type):
+        chunk = _as_bytes(chunk)
+    counts = numpy.bincount(numpy.frombuffer(chunk, dtype=numpy.uint8),
+                            minlength=256)
+    for value, _needle in _byte_table(alphabet):
+        histogram[value] += int(counts[value])
+
+
+def _count_chunk_auto(chunk, histogram, alphabet):
+    """ Stands in until a backend is picked, picks one and hands over. """
+    set_backend('auto')
+    _count_chunk(chunk, histogram, alphabet)
+
+
+_COUNTERS = {'python': _count_chunk_python,
+             'numpy': _count_chunk_numpy}
+_backend_name = None
+_count_chunk = _count_chunk_auto
+
+
+def set_backend(name='auto'):
+    """ Pick how count_chunk() does the work, one of 'auto', 'numpy' or
+    'python'. auto means numpy if it imports, and asking for numpy when it
+    isn't installed drops back to python with a warning. Both give
+    identical counts. Left alone, auto is picked on the first count. """
+    global _count_chunk, _backend_name
+    if name == 'auto':
+        name = 'numpy' if have_numpy() else 'python'
+    elif name == 'numpy' and not have_numpy():
+        log.warning('numpy is not installed, using the python counter')
+        name = 'python'
+    log.debug('counting backend is %s', name)
+    _count_chunk = _COUNTERS[name]
+    _backend_name = name
+    return name
+
+
+def get_backend():
+    """ Name of the counting backend in use, picking one if need be. """
+    if _backend_name is None:
+        return set_backend('auto')
+    return _backend_name
+
+
+def count_chunk(chunk, histogram, alphabet=good_symbols):
+    """ Add the symbols in chunk to histogram, a 256 entry table indexed by
+    byte value. Only the bytes in alphabet are counted. See set_backend()
+    for how the counting gets done. """
+    _count_chunk(chunk, histogram, alphabet)
+    return histogram
+
+
+def count_chunks(chunks, histogram, alphabet=good_symbols):
+    """ count_chunk() everything in chunks, booking the time spent getting
+    each chunk as 'read' and counting it as 'count' in metrics. Returns
+    the number of bytes gone through. """
+    total = 0
+    chunks = iter(chunks)
+    while True:
+        started = time.time()
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            break
+        fetched = time.time()
+        _count_chunk(chunk, histogram, alphabet)
+        size = len(chunk)
+        metrics.add('read', fetched - started, size)
+        metrics.add('count', time.time() - fetched, size)
+        total += size
+    return total
+
+
+def histogram_to_dict(histogram, alphabet=good_symbols):
+    """ Fold a 256 entry histogram back down to the char:number dict that
+    build_coords() expects. """
+    symbol_count = {}
+    for symbol in alphabet:
+        symbol_count[symbol] = histogram[ord(symbol)]
+    return symbol_count
+
+
 def build_list(dataset):
-    """ Pass this a string or tuple of characters, get back a dict, of
-    char:number where number is the number of times that char occurs in
-    the dataset
+    """ Pass this a string, or an iterable of chunks (as handed back by
+    open_file()), get back a dict, of char:number where number is the
+    number of times that char occurs in the dataset
 
     We chop off cr/lf, and
     whitespace. In fact, anything other than numerical, alphabetical are
     pulled. All we care about are the actual symbols.  See good_symbols
     for details on what we want to play with. Adjust accordingly.
 
-    First, we strip out bad_symbols, which are anything not in
-    good_symbols. Then we fill a dict with everything from plaintext that
-    is also present in good symbols, and set the value to 0 to start the
-    ball rolling. If you change good_symbols, be wary of stuff like \
+    Counting is done a chunk at a time into a 256 entry byte table, see
+    count_chunk(), so the dataset never has to be in memory all at once.
+    Every symbol in good_symbols gets an entry, even if the count is 0. If
+    you change good_symbols, be wary of stuff like \
     which are postscript operators and must be dealt with or your output
     will not be correct."""
     log.debug('in build_list')
-    symbol_count = {}
-
-    for symbol in good_symbols:
-        symbol_count[symbol] = 0
-
-    for symbol in dataset:
-        if good_symbols.count(symbol):
-            symbol_count[symbol] = symbol_count.get(symbol, [0]) + 1
+    histogram = new_histogram()
+    if isinstance(dataset, _string_types):
+        dataset = [dataset]
+    count_chunks(dataset, histogram)
+    symbol_count = histogram_to_dict(histogram)
     log.debug('leaving build_list')
     return symbol_count
 
 
+class Histogram(object):
+    """ Symbol counts for one input, a 256 entry table indexed by byte
+    value plus the alphabet they're reported over. This is the handle for
+    using textmap as a library,
+
+        hist = textmap.Histogram.from_file('capture.bin')
+        textmap.draw_map(hist, 'capture.ps')
+
+    or feed it data with update(), a chunk or a whole iterable of them at
+    a time. Any number of threads may update() the same Histogram, each
+    chunk is counted outside the lock and only the sums are serialised. """
+
+    def __init__(self, counts=None, alphabet=good_symbols):
+        self.alphabet = alphabet
+        self.counts = list(counts) if counts is not None else new_histogram()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, filename, jobs=1, use_mmap=True, cache=None,
+                  decompress=True):
+        """ Count a whole file, see count_file() for the options. """
+        return cls(count_file(filename, jobs=jobs, use_mmap=use_mmap,
+                              cache=cache, decompress=decompress))
+
+    def update(self, data):
+        """ Add data, a string or an iterable of chunks, to the counts.
+        Returns the number of bytes counted. """
+        if isinstance(data, _string_types):
+            data = [data]
+        counts = new_histogram()
+        total = count_chunks(data, counts, self.alphabet)
+        self.merge(counts)
+        return total
+
+    def merge(self, other):
+        """ Add in the counts from another Histogram or 256 entry list. """
+        if isinstance(other, Histogram):
+            other = other.counts
+        with self._lock:
+            for value, _needle in _byte_table(self.alphabet):
+                self.counts[value] += other[value]
+        return self
+
+    def total(self):
+        """ How many symbols have been counted. """
+        return sum(self.counts[value]
+                   for value, _needle in _byte_table(self.alphabet))
+
+    def as_dict(self):
+        """ The char:number dict, as build_list() gives. """
+        with self._lock:
+            return histogram_to_dict(self.counts, self.alphabet)
+
+    def __getstate__(self):
+        return {'counts': self.counts, 'alphabet': self.alphabet}
+
+    def __setstate__(self, state):
+        self.__init__(state['counts'], state['alphabet'])
+
+
+def _utf8_tail(data):
+    """ How many bytes at the end of data are the start of a utf-8
+    sequence that carries on past it, 0 to 3. """
+    tail = bytearray(data[-3:])
+    for back in range(1, len(tail) + 1):
+        byte = tail[-back]
+        if byte < 0x80:
+            return 0
+        if byte >= 0xc0:
+            need = 2 if byte < 0xe0 else 3 if byte < 0xf0 else 4
+            return back if need > back else 0
+    return 0
+
+
+class SymbolCounter(object):
+    """ Counts of the letters and digits in utf-8 input, any script, not
+    just the ascii good_symbols. Hybrid storage, the ascii ones go in a
+    dense 256 entry byte table like a Histogram's and everything else in a
+    dict, so an alphabet of a few thousand symbols costs a few thousand
+    dict entries and no more.
+
+    Every byte of a utf-8 multibyte sequence is 0x80 or over, so the ascii
+    symbols can be counted straight off the bytes with count_chunk(),
+    whatever else is in the chunk. Only the runs of non ascii bytes get
+    decoded, and pure ascii chunks never decode anything at all. Finding
+    the runs is a translate() and a split(), both of which go at memory
+    speed, a regex was ten times slower. Malformed
+    sequences decode to U+FFFD and so aren't counted. """
+
+    def __init__(self):
+        self.dense = new_histogram()
+        self.sparse = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, filename, use_mmap=True, decompress=True):
+        """ Count a whole file, - for stdin. """
+        counter = cls()
+        counter.update(open_file(filename, use_mmap=use_mmap,
+                                 decompress=decompress))
+        return counter
+
+    def update(self, data):
+        """ Add data, utf-8 bytes or an iterable of chunks of them, to the
+        counts. Sequences split across chunks are put back together.
+        Returns the number of bytes counted. """
+        if isinstance(data, _string_types):
+            data = [data]
+        dense = new_histogram()
+        sparse = Counter()
+        carry = b''
+        total = 0
+        started = time.time()
+        for chunk in data:
+            total += len(chunk)
+            if carry:
+                chunk = carry + _as_bytes(chunk)
+                carry = b''
+            cut = _utf8_tail(chunk)
+            if cut:
+                carry = _as_bytes(chunk[len(chunk) - cut:])
+                chunk = chunk[:len(chunk) - cut]
+            count_chunk(chunk, dense)
+            chunk = _as_bytes(chunk)
+            if hasattr(chunk, 'isascii') and chunk.isascii():
+                continue
+            runs = chunk.translate(_ASCII_BLANK).split()
+            if runs:
+                sparse.update(b' '.join(runs).decode('utf-8', 'replace'))
+            chunk = None
+        metrics.add('count', time.time() - started, total)
+        with self._lock:
+            for value, _needle in _byte_table(good_symbols):
+                self.dense[value] += dense[value]
+            for symbol, count in sparse.items():
+                if symbol.isalnum():
+                    self.sparse[symbol] = self.sparse.get(symbol, 0) + count
+        return total
+
+    def merge(self, other):
+        """ Add in the counts from another SymbolCounter. """
+        with self._lock:
+            for value in range(256):
+                self.dense[value] += other.dense[value]
+            for symbol, count in other.sparse.items():
+                self.sparse[symbol] = self.sparse.get(symbol, 0) + count
+        return self
+
+    def total(self):
+        """ How many symbols have been counted. """
+        return (sum(self.dense[value]
+                    for value, _needle in _byte_table(good_symbols)) +
+                sum(self.sparse.values()))
+
+    def as_dict(self):
+        """ symbol:number for every ascii symbol in good_symbols and every
+        other symbol seen at least once. """
+        with self._lock:
+            symbol_count = histogram_to_dict(self.dense)
+            symbol_count.update(self.sparse)
+        return dict((_unicode_type(symbol), count)
+                    for symbol, count in symbol_count.items())
+
+    def __getstate__(self):
+        return {'dense': self.dense, 'sparse': self.sparse}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.dense = state['dense']
+        self.sparse = state['sparse']
+
+
+def _rank_table(alphabet):
+    """ 256 byte translate() table taking each symbol in alphabet to its
+    rank (position in alphabet) and every other byte to 255. """
+    table = bytearray([255] * 256)
+    for rank, (value, _needle) in enumerate(_byte_table(alphabet)):
+        table[value] = rank
+    return bytes(table)
+
+
+def _ngram_chunk_python(data, n, size, dense, alphabet):
+    """ Rank translate the chunk, then let Counter run over n zipped,
+    shifted copies of it. All the per byte looping stays in C, and anything
+    touching a non symbol collapses onto rank 255, so the Counter never
+    holds more than (size + 1) ** n keys. """
+    ranks = bytearray(data.translate(_rank_table(alphabet)))
+    grams = Counter(_izip(*[itertools.islice(ranks, i, None)
+                            for i in range(n)]))
+    for gram, count in grams.items():
+        if 255 in gram:
+            continue
+        slot = 0
+        for rank in gram:
+            slot = slot * size + rank
+        dense[slot] += count
+
+
+def _ngram_chunk_numpy(data, n, size, dense, alphabet):
+    """ Rank look up the chunk as an array, turn every run of n ranks into
+    one flat index and bincount them. """
+    lut = numpy.frombuffer(_rank_table(alphabet), dtype=numpy.uint8)
+    ranks = lut[numpy.frombuffer(data, dtype=numpy.uint8)]
+    length = len(ranks) - n + 1
+    if length <= 0:
+        return
+    valid = numpy.ones(length, dtype=bool)
+    slots = numpy.zeros(length, dtype=numpy.int64)
+    for i in range(n):
+        shifted = ranks[i:i + length]
+        valid &= shifted != 255
+        slots = slots * size + shifted
+    dense += numpy.bincount(slots[valid], minlength=size ** n)
+
+
+def count_ngrams(dataset, n=2, alphabet=good_symbols):
+    """ Count runs of n adjacent symbols (2 for pairs, 3 for triples) in
+    dataset, a string or an iterable of chunks like build_list() takes.
+    The counts come back as a dense flat list indexed by symbol rank, so
+    the pair (a, b) is at rank(a) * len(alphabet) + rank(b), 62 * 62 slots
+    for bigrams over good_symbols. Whole chunks are counted at a time, the
+    last n - 1 bytes of each are carried over so runs crossing a chunk
+    edge aren't lost. """
+    log.debug('in count_ngrams')
+    size = len(_byte_table(alphabet))
+    if get_backend() == 'numpy':
+        dense = numpy.zeros(size ** n, dtype=numpy.int64)
+        counter = _ngram_chunk_numpy
+    else:
+        dense = [0] * (size ** n)
+        counter = _ngram_chunk_python
+    if isinstance(dataset, _string_types):
+        dataset = [dataset]
+    tail = b''
+    started = time.time()
+    total = 0
+    for chunk in dataset:
+        data = tail + _as_bytes(chunk) if tail else _as_bytes(chunk)
+        counter(data, n, size, dense, alphabet)
+        tail = bytes(data[-(n - 1):]) if n > 1 else b''
+        total += len(chunk)
+    metrics.add('count', time.time() - started, total)
+    if not isinstance(dense, list):
+        dense = [int(count) for count in dense]
+    log.debug('leaving count_ngrams')
+    return dense
+
+
+def ngram_dict(dense, n, alphabet=good_symbols, top=None):
+    """ Fold dense n-gram counts back into a gram:number dict, like the one
+    build_list() gives for single symbols, keeping only the top most common
+    (all nonzero ones if top is None). """
+    symbols = [chr(value) for value, _needle in _byte_table(alphabet)]
+    size = len(symbols)
+    slots = [slot for slot in range(len(dense)) if dense[slot]]
+    if top is not None:
+        slots = sorted(slots, key=lambda slot: -dense[slot])[:top]
+    grams = {}
+    for slot in slots:
+        gram = []
+        rest = slot
+        for _i in range(n):
+            rest, rank = divmod(rest, size)
+            gram.append(symbols[rank])
+        grams[''.join(reversed(gram))] = dense[slot]
+    return grams
+
+
+class NgramSketch(object):
+    """ Approximate counts of every n byte run in the input (n up to 8, any
+    byte values, not just the alphabet) in a count-min sketch of fixed size,
+    depth rows of width counters, plus the top most frequent n-grams seen so
+    far. memory bytes is what the table gets, width is the biggest power of
+    two that fits.
+
+    Every estimate is at least the true count, and with probability at
+    least 1 - exp(-depth) no more than error() over it. Sketches built with
+    the same n, memory, depth and seed (by default they are) on different
+    shards can be merge()d, or save()d and load()ed to be merged somewhere
+    else. Each chunk is hashed and counted as whole arrays with numpy, or a
+    Counter at a time without. """
+
+    def __init__(self, n=3, memory=SKETCH_MEMORY, depth=4, top=62, seed=0):
+        if not 1 <= n <= 8:
+            raise ValueError('sketches take n-grams of 1 to 8 bytes')
+        self.n = n
+        self.depth = depth
+        self.top = top
+        self.seed = seed
+        self.bits = max(10, (max(1, memory // (8 * depth))).bit_length() - 1)
+        self.width = 1 << self.bits
+        self.total = 0
+        self.heavy = {}
+        rand = __import__('random').Random(seed)
+        self._hashes = [(rand.getrandbits(64) | 1, rand.getrandbits(64))
+                        for _row in range(depth)]
+        if get_backend() == 'numpy':
+            import numpy as np
+            self.table = np.zeros((depth, self.width), dtype=np.int64)
+        else:
+            self.table = [[0] * self.width for _row in range(depth)]
+
+    def error(self):
+        """ How far over the true count an estimate may be, e / width of
+        everything counted. """
+        return math.e / self.width * self.total
+
+    def update(self, data):
+        """ Add data, a string or an iterable of chunks, carrying n - 1 bytes
+        over so runs across chunk edges are counted. Returns the number of
+        bytes counted. """
+        if isinstance(data, _string_types):
+            data = [data]
+        tail = b''
+        total = 0
+        started = time.time()
+        for chunk in data:
+            total += len(chunk)
+            chunk = tail + _as_bytes(chunk) if tail else _as_bytes(chunk)
+            if isinstance(self.table, list):
+                self._update_python(chunk)
+            else:
+                self._update_numpy(chunk)
+            tail = chunk[len(chunk) - self.n + 1:] if self.n > 1 else b''
+        metrics.add('sketch', time.time() - started, total)
+        return total
+
+    def _keys_numpy(self, chunk):
+        """ Every n-gram in chunk as a 64 bit key, n bytes big endian. """
+        import numpy as np
+        data = np.frombuffer(chunk, dtype=np.uint8)
+        length = len(data) - self.n + 1
+        if length <= 0:
+            return np.zeros(0, dtype=np.uint64)
+        keys = np.zeros(length, dtype=np.uint64)
+        for i in range(self.n):
+            keys <<= np.uint64(8)
+            keys |= data[i:i + length]
+        return keys
+
+    def _slots_numpy(self, keys):
+        """ The counter each key lands on in each row, multiply shift
+        hashing, a row per array. """
+        import numpy as np
+        shift = np.uint64(64 - self.bits)
+        with np.errstate(over='ignore'):
+            return [((keys * np.uint64(a) + np.uint64(b)) >> shift).astype(
+                np.intp) for a, b in self._hashes]
+
+    def _estimates_numpy(self, keys, slots=None):
+        """ Estimates for an array of keys, the smallest of their counters. """
+        import numpy as np
+        if slots is None:
+            slots = self._slots_numpy(keys)
+        estimates = self.table[0][slots[0]]
+        for row in range(1, self.depth):
+            estimates = np.minimum(estimates, self.table[row][slots[row]])
+        return estimates
+
+    def _update_numpy(self, chunk):
+        import numpy as np
+        keys = self._keys_numpy(chunk)
+        if not len(keys):
+            return
+        self.total += len(keys)
+        # Text repeats itself a lot, hashing each distinct n-gram once with
+        # its count is far less work than hashing every one.
+        keys, counts = np.unique(keys, return_counts=True)
+        slots = self._slots_numpy(keys)
+        for row, slot in enumerate(slots):
+            np.add.at(self.table[row], slot, counts)
+        # Only keys that could make the top are worth looking at.
+        floor = self._floor()
+        if floor:
+            keys = keys[self._estimates_numpy(keys, slots) >= floor]
+        keys = np.union1d(keys, np.array(list(self.heavy), dtype=np.uint64))
+        estimates = self._estimates_numpy(keys)
+        if len(keys) > self.top:
+            best = np.argpartition(-estimates, self.top - 1)[:self.top]
+            keys = keys[best]
+            estimates = estimates[best]
+        self.heavy = dict(_izip(keys.tolist(), estimates.tolist()))
+
+    def _update_python(self, chunk):
+        grams = Counter(_izip(*[itertools.islice(bytearray(chunk), i, None)
+                                for i in range(self.n)]))
+        mask = (1 << 64) - 1
+        shift = 64 - self.bits
+        keys = []
+        for gram, count in grams.items():
+            key = 0
+            for byte in gram:
+                key = key << 8 | byte
+            for row, (a, b) in enumerate(self._hashes):
+                self.table[row][((a * key + b) & mask) >> shift] += count
+            self.total += count
+            keys.append(key)
+        self._track(keys)
+
+    def _floor(self):
+        """ The smallest estimate in the top, once it's full. """
+        if len(self.heavy) < self.top:
+            return 0
+        return min(self.heavy.values())
+
+    def estimate(self, key):
+        """ Estimated count for one n-gram key. """
+        mask = (1 << 64) - 1
+        shift = 64 - self.bits
+        return min(int(self.table[row][((a * key + b) & mask) >> shift])
+                   for row, (a, b) in enumerate(self._hashes))
+
+    def _track(self, keys):
+        """ Re-estimate the top and the new candidate keys, keep the best. """
+        floor = self._floor()
+        for key in keys:
+            if key not in self.heavy:
+                count = self.estimate(key)
+                if count >= floor:
+                    self.heavy[key] = count
+        for key in self.heavy:
+            self.heavy[key] = self.estimate(key)
+        if len(self.heavy) > self.top:
+            keep = sorted(self.heavy.items(), key=lambda item: -item[1])
+            self.heavy = dict(keep[:self.top])
+
+    def merge(self, other):
+        """ Add another sketch's counts to this one. They have to have been
+        made with the same n, size, depth and seed. """
+        if (other.n, other.width, other.depth, other.seed) != (
+                self.n, self.width, self.depth, self.seed):
+            raise ValueError('sketches of different shapes cannot be merged')
+        if isinstance(self.table, list):
+            for mine, theirs in _izip(self.table, other.table):
+                for slot in range(self.width):
+                    mine[slot] += int(theirs[slot])
+        else:
+            self.table += other.table
+        self.total += other.total
+        self._track(list(other.heavy))
+        return self
+
+    def grams(self):
+        """ The top n-grams, most frequent first, as (gram, estimate, low)
+        where gram is the n bytes and the true count is, with probability
+        1 - exp(-depth), between low and estimate. """
+        slack = self.error()
+        result = []
+        for key, count in sorted(self.heavy.items(),
+                                 key=lambda item: (-item[1], item[0]))[
+                                     :self.top]:
+            gram = bytes(bytearray((key >> 8 * (self.n - 1 - i)) & 0xff
+                                   for i in range(self.n)))
+            result.append((gram, count, max(0, int(count - slack))))
+        return result
+
+    def save(self, filename):
+        """ Write the sketch to filename, to be load()ed and merged later. """
+        keys = sorted(self.heavy)
+        if isinstance(self.table, list):
+            table = b''.join(struct.pack('<%dq' % self.width, *row)
+                             for row in self.table)
+        else:
+            table = self.table.astype('<i8').tobytes()
+        data = (_SKETCH_HEADER.pack(SKETCH_MAGIC, SKETCH_VERSION, self.n,
+                                    self.depth, self.width, self.top,
+                                    self.seed, self.total, len(keys)) +
+                struct.pack('<%dQ' % len(keys), *keys) + table)
+        return _atomic_write(filename, data)
+
+    @classmethod
+    def load(cls, filename):
+        """ A sketch written by save(). """
+        _input = open(filename, 'rb')
+        try:
+            data = _input.read()
+        finally:
+            _input.close()
+        (magic, version, n, depth, width, top, seed, total,
+         tracked) = _SKETCH_HEADER.unpack_from(data, 0)
+        if magic != SKETCH_MAGIC or version != SKETCH_VERSION:
+            raise ValueError('%s is not a textmap sketch' % filename)
+        start = _SKETCH_HEADER.size
+        if len(data) != start + 8 * tracked + 8 * depth * width:
+            raise ValueError('%s is truncated' % filename)
+        sketch = cls(n, 8 * depth * width, depth, top, seed)
+        keys = struct.unpack_from('<%dQ' % tracked, data, start)
+        start += 8 * tracked
+        if isinstance(sketch.table, list):
+            sketch.table = [list(struct.unpack_from(
+                '<%dq' % width, data, start + 8 * width * row))
+                for row in range(depth)]
+        else:
+            import numpy as np
+            sketch.table = np.frombuffer(data, dtype='<i8', offset=start,
+                                         count=depth * width).reshape(
+                depth, width).astype(np.int64)
+        sketch.total = total
+        sketch.heavy = dict((key, sketch.estimate(key)) for key in keys)
+        return sketch
+
+
+def gram_label(gram):
+    """ An n-gram's bytes as readable text, anything that isn't printable
+    ascii as a \\xhh escape. """
+    return ''.join(chr(byte) if 33 <= byte < 127 else '\\x%02x' % byte
+                   for byte in bytearray(gram))
+
+
+def format_sketch(sketch, report='table'):
+    """ The top n-grams of sketch with their error bounds, as a table or
+    json. """
+    grams = sketch.grams()
+    if report == 'json':
+        import json
+        return json.dumps({'n': sketch.n, 'total': sketch.total,
+                           'width': sketch.width, 'depth': sketch.depth,
+                           'error': sketch.error(),
+                           'confidence': 1 - math.exp(-sketch.depth),
+                           'top': [{'gram': gram_label(gram),
+                                    'estimate': count, 'low': low}
+                                   for gram, count, low in grams]},
+                          sort_keys=True) + '\n'
+    lines = ['%d-grams, %d counted, estimates at most %.1f high with %.1f%% '
+             'confidence' % (sketch.n, sketch.total, sketch.error(),
+                             100 * (1 - math.exp(-sketch.depth))),
+             '%4s %-24s %14s %14s' % ('#', 'gram', 'estimate', 'at least')]
+    for rank, (gram, count, low) in enumerate(grams):
+        lines.append('%4d %-24s %14d %14d' % (rank, gram_label(gram), count,
+                                              low))
+    return '\n'.join(lines) + '\n'
+
+
 def build_coords(symbol_dict, char_sep):
     """ Create a list of the coords for the charmap"""
     log.debug('in build_coords')
@@ -139,6 +1216,7 @@ def build_coords(symbol_dict, char_sep):
     R_coords = {}
     P_coords = {}
     biggest = 0
+    scale_factor = 0.0  # Stays 0 if nothing counted, everything at center.
     for char in symbol_dict.keys():
         freq = symbol_dict[char]
         if biggest < freq:
@@ -157,34 +1235,1988 @@ def build_coords(symbol_dict, char_sep):
     return R_coords
 
 
-def open_file(filename):
-    """ Should really break this up, and not gulp entire file at once. But
-    for now, will leave the read() alone.  """
+def read_chunks(_input, chunk_size=CHUNK_SIZE, limit=None):
+    """ Yield chunk_size pieces of an open file until it runs dry, or limit
+    bytes have gone by, then close it. Memory use stays at about one chunk,
+    whatever the file size."""
+    try:
+        while limit is None or limit > 0:
+            want = chunk_size if limit is None else min(chunk_size, limit)
+            chunk = _input.read(want)
+            if not chunk:
+                break
+            if limit is not None:
+                limit -= len(chunk)
+            yield chunk
+    finally:
+        _input.close()
+
+
+def map_chunks(mapped, _input, chunk_size=CHUNK_SIZE, start=0, end=None):
+    """ Yield chunk_size windows straight onto the mapped pages between
+    start and end, nothing is read() or copied here. Unmaps and closes the
+    file when done. """
+    if end is None or end > len(mapped):
+        end = len(mapped)
+    try:
+        for offset in range(start, end, chunk_size):
+            yield _view(mapped, offset, min(chunk_size, end - offset))
+    finally:
+        try:
+            mapped.close()
+        except BufferError:
+            # A caller is still holding a view, the pages go when it does.
+            log.debug('mapping still in use, leaving it for gc')
+        _input.close()
+
+
+def _map_file(_input):
+    """ Try and mmap an open file read only. Returns None for anything that
+    is empty, isn't a regular file, or just won't map, so the caller can
+    fall back to plain reads. """
+    info = os.fstat(_input.fileno())
+    if not stat.S_ISREG(info.st_mode) or not info.st_size:
+        return None
+    try:
+        return mmap.mmap(_input.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError) as Err:
+        log.debug('could not mmap %s, %s', _input.name, Err)
+        return None
+
+
+def _open_input(filename):
+    """ Open filename for binary reading, - meaning stdin. stdin comes back
+    as its own duplicate file descriptor, so closing it when we're done
+    leaves the real one alone. Either way it's an io buffered reader, so
+    peek() and seekable() are there on python 2 as well. """
+    import io
+    if filename == '-':
+        return io.open(os.dup(sys.stdin.fileno()), 'rb')
+    return io.open(filename, 'rb')
+
+
+def _sniff(_input):
+    """ Which compressed format _input holds, going by its first few bytes,
+    or None for anything else. Regular files are rewound after, pipes are
+    only peeked at. """
+    try:
+        if _input.seekable():
+            head = _input.read(6)
+            _input.seek(0)
+        else:
+            head = _input.peek(6)[:6]
+    except (AttributeError, EnvironmentError):
+        return None
+    for magic, kind in MAGIC:
+        if head.startswith(magic):
+            return kind
+    return None
+
+
+def _decompressor(kind, _input):
+    """ File like object decompressing _input as it is read, so memory stays
+    at about a chunk however big the data inflates to. """
+    if kind == 'gzip':
+        import gzip
+        return gzip.GzipFile(fileobj=_input, mode='rb')
+    if kind == 'bz2':
+        import bz2
+        return bz2.BZ2File(_input)
+    try:
+        import lzma
+    except ImportError:
+        raise ValueError('xz input needs the lzma module (python 3)')
+    return lzma.LZMAFile(_input)
+
+
+def inflate_chunks(kind, _input, chunk_size=CHUNK_SIZE):
+    """ Python 2 stand in for _decompressor(), whose GzipFile wants to seek
+    and whose BZ2File only takes a filename. Feeds _input through an
+    incremental decompressor a small piece at a time and yields what comes
+    out, following concatenated streams (cat a.gz b.gz, pigz, pbzip2) on
+    to the end. gzip output is held to chunk_size per go, bzip2 can't be
+    told that so it gets fed slowly instead. """
+    import zlib
+    import bz2
+    if kind == 'lzma':
+        _input.close()
+        raise ValueError('xz input needs the lzma module (python 3)')
+
+    def fresh():
+        if kind == 'gzip':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return bz2.BZ2Decompressor()
+
+    inflater = fresh()
+    for raw in read_chunks(_input, 64 * 1024):
+        while raw:
+            if kind == 'gzip':
+                data = inflater.decompress(raw, chunk_size)
+                raw = inflater.unconsumed_tail
+            else:
+                try:
+                    data = inflater.decompress(raw)
+                except EOFError:
+                    # finished stream, so raw must be the next one
+                    inflater = fresh()
+                    continue
+                raw = b''
+            if data:
+                yield data
+            if not raw and inflater.unused_data:
+                raw = inflater.unused_data
+                inflater = fresh()
+
+
+def is_compressed(filename):
+    """ True if open_file() would decompress filename. """
+    if filename == '-':
+        return False
+    try:
+        _input = _open_input(filename)
+    except EnvironmentError:
+        return False
+    try:
+        return _sniff(_input) is not None
+    finally:
+        _input.close()
+
+
+def read_decompressed(stream, _input, chunk_size=CHUNK_SIZE):
+    """ read_chunks() for a decompressor, closing the raw file under it as
+    well once done. """
+    try:
+        for chunk in read_chunks(stream, chunk_size):
+            yield chunk
+    finally:
+        _input.close()
+
+
+def open_file(filename, chunk_size=CHUNK_SIZE, use_mmap=True, start=0,
+              end=None, decompress=True):
+    """ Open the file and hand back an iterator over it, chunk_size bytes at
+    a time, rather than gulping the entire file at once. Leading and
+    trailing whitespace used to be stripped here, it never counted for
+    anything so now we just leave it be. start and end pick out a byte
+    range, by default the whole file. A filename of - reads stdin.
+
+    With use_mmap the file is mapped and the chunks are views onto the
+    mapping, which for files already in the page cache means next to no
+    copying at all. Files that can't be mapped get buffered reads.
+
+    gzip, bzip2 and xz input is decompressed on the fly, a chunk at a time,
+    when reading the whole thing with decompress on. Byte ranges always
+    mean bytes of the file as it sits on disk."""
     log.debug('in open_file')
-    _input = open(filename)
+    _input = _open_input(filename)
+    if decompress and not start and end is None:
+        kind = _sniff(_input)
+        if kind is not None:
+            log.debug('reading %s as %s', filename, kind)
+            if sys.version_info[0] < 3:
+                log.debug('leaving open_file')
+                return inflate_chunks(kind, _input, chunk_size)
+            try:
+                stream = _decompressor(kind, _input)
+            except:
+                _input.close()
+                raise
+            log.debug('leaving open_file')
+            return read_decompressed(stream, _input, chunk_size)
+    mapped = None
+    if use_mmap:
+        mapped = _map_file(_input)
+    log.debug('leaving open_file')
+    if mapped is not None:
+        return map_chunks(mapped, _input, chunk_size, start, end)
+    if start:
+        _input.seek(start)
+    limit = None if end is None else max(end - start, 0)
+    return read_chunks(_input, chunk_size, limit)
+
+
+def default_jobs():
+    """ One worker per cpu, if we can find out how many there are. """
+    import multiprocessing
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def split_ranges(size, pieces, align=1):
+    """ Carve size bytes up into pieces (start, end) ranges of about the
+    same length, each starting on a multiple of align. """
+    step = -(-size // pieces)
+    step = max(align, -(-step // align) * align)
+    return [(start, min(start + step, size)) for start in range(0, size, step)]
+
+
+def count_range(task):
+    """ Worker side of count_file(), count one byte range of a file and
+    hand the 256 entry histogram back. task is (filename, start, end,
+    use_mmap, backend, decompress), all in one tuple so it can go through
+    Pool.map. """
+    filename, start, end, use_mmap, backend, decompress = task
+    if backend != get_backend():
+        set_backend(backend)
+    histogram = new_histogram()
+    count_chunks(open_file(filename, use_mmap=use_mmap, start=start, end=end,
+                           decompress=decompress), histogram)
+    return histogram
+
+
+def count_file(filename, jobs=1, use_mmap=True, cache=None, decompress=True):
+    """ Count a whole file into a 256 entry histogram. Big regular files
+    are split into jobs byte ranges, each one counted by its own worker
+    process and the results summed. Anything under PARALLEL_THRESHOLD, or
+    that we can't seek around in (stdin, compressed files), stays in this
+    process. Given a HistogramCache, a hit skips the reading and counting
+    altogether."""
+    log.debug('in count_file')
+    key = None
+    if cache is not None:
+        with metrics.stage('cache'):
+            key = cache.key(filename, decompress)
+            histogram = cache.get(key)
+        if histogram is not None:
+            log.debug('leaving count_file, cache hit for %s', filename)
+            return histogram
+    histogram = _count_file(filename, jobs, use_mmap, decompress)
+    if key is not None:
+        cache.put(key, histogram, filename)
+    log.debug('leaving count_file')
+    return histogram
+
+
+def _count_file(filename, jobs, use_mmap, decompress):
+    """ The uncached half of count_file(). """
+    size = 0
+    if filename != '-' and os.path.isfile(filename):
+        size = os.path.getsize(filename)
+    if jobs is None:
+        jobs = default_jobs()
+    if (jobs <= 1 or size < PARALLEL_THRESHOLD or
+            (decompress and is_compressed(filename))):
+        return count_range((filename, 0, None, use_mmap, get_backend(),
+                            decompress))
+    tasks = [(filename, start, end, use_mmap, get_backend(), False)
+             for start, end in split_ranges(size, jobs)]
+    log.debug('counting %s in %d ranges', filename, len(tasks))
+    import multiprocessing
+    started = time.time()
+    pool = multiprocessing.Pool(min(jobs, len(tasks)))
+    try:
+        results = pool.map(count_range, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    # The workers' reading is folded in here, it happens in their address
+    # space, not ours.
+    metrics.add('count', time.time() - started, size)
+    histogram = new_histogram()
+    for partial in results:
+        for value in range(256):
+            histogram[value] += partial[value]
+    return histogram
+
+
+class Checkpoint(object):
+    """ Progress of a long scan, kept in a small json state file so a crash
+    or a kill only loses the work since the last save. due() is asked after
+    every chunk and says when every_bytes more have gone by, or
+    every_seconds, and save() replaces the state file in one rename, so
+    there is always a whole checkpoint on disk, the old one or the new. """
+
+    def __init__(self, filename, every_bytes=CHECKPOINT_BYTES,
+                 every_seconds=CHECKPOINT_SECONDS):
+        self.filename = filename
+        self.every_bytes = every_bytes
+        self.every_seconds = every_seconds
+        self.saves = 0
+        self._bytes = 0
+        self._last = time.time()
+
+    def due(self, size):
+        """ Count size more bytes done, True if it's time to save. """
+        self._bytes += size
+        if self.every_bytes and self._bytes >= self.every_bytes:
+            return True
+        return bool(self.every_seconds and
+                    time.time() - self._last >= self.every_seconds)
+
+    def save(self, **state):
+        """ Write state (plain json-able values) out as the checkpoint. The
+        temp file is synced before it is renamed over the old one. """
+        import json
+        state['version'] = CHECKPOINT_VERSION
+        text = json.dumps(state, sort_keys=True)
+        with metrics.stage('checkpoint', len(text)):
+            _atomic_write(self.filename, text, binary=False, sync=True)
+        self.saves += 1
+        self._bytes = 0
+        self._last = time.time()
+        log.debug('checkpoint %d saved to %s', self.saves, self.filename)
+
+    def load(self):
+        """ The saved state, or None if there's no checkpoint yet. Raises
+        ValueError for a file that isn't one of ours. """
+        import json
+        try:
+            _input = open(self.filename)
+        except EnvironmentError as Err:
+            if Err.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            state = json.load(_input)
+        except ValueError:
+            state = None
+        finally:
+            _input.close()
+        if not isinstance(state, dict) or \
+                state.get('version') != CHECKPOINT_VERSION:
+            raise ValueError('%s is not a textmap checkpoint' %
+                             self.filename)
+        return state
+
+    def resume(self, source):
+        """ The saved state for source, None if there's no checkpoint to
+        start from. A checkpoint for anything else is a ValueError, it
+        would only give wrong counts. """
+        state = self.load()
+        if state is None:
+            log.warning('no checkpoint in %s, starting from the beginning',
+                        self.filename)
+            return None
+        if state.get('source') != source:
+            raise ValueError('%s was saved from a different scan, or the '
+                             'input has changed since' % self.filename)
+        return state
+
+    def remove(self):
+        """ Done with, the scan finished. """
+        _remove(self.filename)
+
+
+def scan_source(filename, decompress=True):
+    """ What a checkpoint remembers about the input, to be sure a resume
+    carries on with the same one. Plain files are their real path, size
+    and mtime, anything else (a corpus) just the name. """
+    source = {'name': filename, 'alphabet': good_symbols,
+              'decompress': decompress}
+    if os.path.isfile(filename):
+        info = os.stat(filename)
+        source.update(name=os.path.realpath(filename), size=info.st_size,
+                      mtime=info.st_mtime)
+    return source
+
+
+def checkpointed_count(filename, checkpoint, resume=False, use_mmap=True,
+                       decompress=True):
+    """ count_file() for inputs too big to count in one go, saving the
+    histogram and the offset reached to checkpoint as it goes. With resume
+    the count carries on from the last save. Counted in this process, a
+    chunk at a time, whatever jobs says, the one offset is all there is to
+    remember. A compressed file resumes at an offset into the decompressed
+    data, which has to be read back up to there but isn't counted again.
+    The checkpoint is removed once the count is done. """
+    log.debug('in checkpointed_count')
+    source = scan_source(filename, decompress)
+    histogram = new_histogram()
+    offset = 0
+    state = checkpoint.resume(source) if resume else None
+    if state is not None:
+        histogram = state['histogram']
+        offset = state['offset']
+        log.info('resuming %s at %s', filename, format_size(offset))
+    position = 0
+    if decompress and is_compressed(filename):
+        chunks = open_file(filename, use_mmap=use_mmap)
+    else:
+        chunks = open_file(filename, use_mmap=use_mmap, start=offset,
+                           decompress=decompress)
+        position = offset
+
+    def counting(position):
+        for chunk in chunks:
+            if position < offset:
+                # Decompressed data we counted before the last save.
+                skip = min(len(chunk), offset - position)
+                position += skip
+                chunk = chunk[skip:]
+                if not len(chunk):
+                    continue
+            yield chunk
+            # Back here once count_chunks() has counted it.
+            position += len(chunk)
+            if checkpoint.due(len(chunk)):
+                checkpoint.save(source=source, offset=position,
+                                histogram=histogram)
+
+    count_chunks(counting(position), histogram)
+    checkpoint.remove()
+    log.debug('leaving checkpointed_count')
+    return histogram
+
+
+def _spread_order(count):
+    """ range(count) shuffled so that any leading part of it is spread
+    evenly over the whole range, 0, half way, a quarter, three quarters and
+    so on (bit reversed order). """
+    bits = max(1, (count - 1).bit_length())
+    return sorted(range(count),
+                  key=lambda index: int(bin(index)[2:].zfill(bits)[::-1], 2))
+
+
+class Sample(object):
+    """ An estimate of a file's symbol counts from a sample of its blocks,
+    see sample_file(). counts is a 256 entry histogram scaled up to the
+    whole file, intervals maps each symbol to the (low, high) 95%
+    confidence interval on its share of all symbols, or None if too few
+    blocks were read to say. """
+
+    def __init__(self, filename, counts, intervals, blocks, read, size,
+                 elapsed, alphabet=good_symbols):
+        self.filename = filename
+        self.counts = counts
+        self.intervals = intervals
+        self.blocks = blocks
+        self.read = read
+        self.size = size
+        self.elapsed = elapsed
+        self.alphabet = alphabet
+
+    def fraction(self):
+        """ How much of the file was actually read. """
+        return float(self.read) / self.size if self.size else 1.0
+
+    def error(self):
+        """ The widest half interval over all symbols, as a share of all
+        symbols, None if there are no intervals. """
+        widths = [(high - low) / 2.0
+                  for low, high in filter(None, self.intervals.values())]
+        if len(widths) != len(self.intervals) or not widths:
+            return None
+        return max(widths)
+
+    def note(self):
+        """ One line saying how approximate this is, for the map and the
+        terminal. """
+        error = self.error()
+        return 'APPROXIMATE: %.2f%% of %s sampled in %.2fs, %s' % (
+            100.0 * self.fraction(), format_size(self.size), self.elapsed,
+            'symbol shares +/- %.2f%% (95%%)' % (100.0 * error)
+            if error is not None else 'too few blocks for error bars')
+
+
+def format_size(size):
+    """ size in bytes, short and human readable. """
+    for unit in ('', 'K', 'M', 'G'):
+        if size < 1024:
+            return '%d%sB' % (size, unit) if not unit else '%.1f%sB' % (
+                size, unit)
+        size /= 1024.0
+    return '%.1fTB' % size
+
+
+def sample_file(filename, fraction=0.01, block=SAMPLE_BLOCK,
+                spread='random', seconds=None, max_bytes=None, seed=None,
+                use_mmap=True, alphabet=good_symbols):
+    """ Estimate the symbol counts of filename from fraction of its blocks
+    (block bytes each) rather than every byte. spread is 'random', blocks
+    picked at random (seed makes that repeatable), or 'even', evenly spaced
+    through the file. Either way they are read in an order where stopping
+    early still leaves a spread out sample, so seconds and max_bytes can cut
+    it short. Needs a regular, uncompressed file to seek around in. Returns
+    a Sample.
+
+    The blocks are treated as a cluster sample, a symbol's share of the
+    file is estimated as its share of the blocks read, and the interval
+    comes from how much that share varies from block to block (with the
+    finite population correction, so reading every block gives an
+    interval of nothing). Under 30 blocks it's a Student's t interval,
+    a normal one would claim more than it knows. """
+    log.debug('in sample_file')
+    if filename == '-' or not os.path.isfile(filename):
+        raise ValueError('%s is not a regular file, it cannot be sampled' %
+                         filename)
+    if is_compressed(filename):
+        raise ValueError('%s is compressed, it cannot be sampled' % filename)
+    started = time.time()
+    size = os.path.getsize(filename)
+    total_blocks = max(1, -(-size // block))
+    wanted = min(total_blocks, max(2, int(math.ceil(total_blocks *
+                                                    fraction))))
+    if spread == 'even':
+        step = float(total_blocks) / wanted
+        picks = [int(index * step) for index in _spread_order(wanted)]
+    else:
+        import random
+        picks = random.Random(seed).sample(range(total_blocks), wanted)
+    table = _byte_table(alphabet)
+    _input = open(filename, 'rb')
+    mapped = _map_file(_input) if use_mmap else None
+    rows = []
+    read = 0
+    try:
+        for pick in picks:
+            if len(rows) > 1 and ((seconds is not None and
+                                   time.time() - started >= seconds) or
+                                  (max_bytes is not None and
+                                   read >= max_bytes)):
+                break
+            start = pick * block
+            length = min(block, size - start)
+            if mapped is not None:
+                chunk = _view(mapped, start, length)
+            else:
+                _input.seek(start)
+                chunk = _input.read(length)
+            histogram = new_histogram()
+            count_chunk(chunk, histogram, alphabet)
+            rows.append([histogram[value] for value, _needle in table])
+            read += length
+            chunk = None
+        metrics.add('sample', time.time() - started, read)
+    finally:
+        if mapped is not None:
+            mapped.close()
+        _input.close()
+    counts, intervals = _estimate(rows, total_blocks, size, read, alphabet)
+    log.debug('leaving sample_file')
+    return Sample(filename, counts, intervals, len(rows), read, size,
+                  time.time() - started, alphabet)
+
+
+def _estimate(rows, total_blocks, size, read, alphabet):
+    """ The whole file histogram and per symbol intervals from the per block
+    counts in rows, see sample_file(). """
+    table = _byte_table(alphabet)
+    blocks = len(rows)
+    sizes = [sum(row) for row in rows]
+    symbols = float(sum(sizes))
+    scale = float(size) / read if read else 0.0
+    counts = new_histogram()
+    intervals = {}
+    mean = symbols / blocks if blocks else 0.0
+    correction = max(0.0, 1.0 - float(blocks) / total_blocks)
+    quantile = SAMPLE_Z
+    if 1 < blocks <= len(SAMPLE_T) + 1:
+        quantile = SAMPLE_T[blocks - 2]
+    for column, (value, needle) in enumerate(table):
+        found = sum(row[column] for row in rows)
+        counts[value] = int(round(found * scale))
+        symbol = needle.decode('latin-1')
+        if not symbols or (blocks < 2 and correction):
+            intervals[symbol] = None
+            continue
+        share = found / symbols
+        half = 0.0
+        if correction:
+            spread = sum((row[column] - share * width) ** 2
+                         for row, width in _izip(rows, sizes)) / (blocks - 1)
+            half = quantile * math.sqrt(correction * spread /
+                                        (blocks * mean * mean))
+        intervals[symbol] = (max(0.0, share - half), min(1.0, share + half))
+    return counts, intervals
+
+
+class HistogramCache(object):
+    """ On disk cache of per file histograms, one small json file per entry
+    in directory. Entries are keyed on the file's real path, size and mtime
+    (and with use_hash, a sha1 of the contents too, at the price of reading
+    the file). Once the directory goes over limit bytes the least recently
+    used entries are dropped. Plain attributes only, so it pickles across
+    to worker processes. """
+
+    def __init__(self, directory=CACHE_DIR, limit=CACHE_LIMIT,
+                 use_hash=False):
+        self.directory = directory
+        self.limit = limit
+        self.use_hash = use_hash
+
+    def key(self, filename, decompress=True):
+        """ Cache key for filename, or None if it isn't a regular file we
+        can stat, those never get cached. decompress is part of the key,
+        a compressed file counted raw is a different histogram. """
+        try:
+            info = os.stat(filename)
+        except EnvironmentError:
+            return None
+        if not stat.S_ISREG(info.st_mode):
+            return None
+        import hashlib
+        mtime = getattr(info, 'st_mtime_ns', None) or repr(info.st_mtime)
+        parts = [str(CACHE_VERSION), os.path.realpath(filename),
+                 str(info.st_size), str(mtime), good_symbols,
+                 'inflate' if decompress else 'raw']
+        if self.use_hash:
+            digest = hashlib.sha1()
+            for chunk in open_file(filename):
+                digest.update(chunk)
+            parts.append(digest.hexdigest())
+        return hashlib.sha1('\0'.join(parts).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        """ The cached histogram for key, or None on a miss. """
+        if key is None:
+            return None
+        import json
+        path = self._path(key)
+        try:
+            _input = open(path)
+            try:
+                histogram = json.load(_input)['histogram']
+            finally:
+                _input.close()
+            # Touch it, so trim() sees it as recently used.
+            os.utime(path, None)
+        except (EnvironmentError, ValueError, KeyError):
+            return None
+        if len(histogram) != 256:
+            return None
+        return histogram
+
+    def put(self, key, histogram, filename=None):
+        """ Store histogram under key, then trim the cache back under its
+        limit. The entry is written to a temp file and renamed into place
+        so readers never see half an entry. """
+        try:
+            os.makedirs(self.directory)
+        except EnvironmentError as Err:
+            if Err.errno != errno.EEXIST:
+                log.warning('could not create cache directory, %s', Err)
+                return
+        import json
+        try:
+            _atomic_write(self._path(key), json.dumps(
+                {'source': filename, 'histogram': histogram}), binary=False)
+        except EnvironmentError as Err:
+            log.warning('could not write cache entry, %s', Err)
+            return
+        global _cache_puts
+        _cache_puts += 1
+        if _cache_puts % CACHE_TRIM_EVERY == 1:
+            self.trim()
+
+    def _entries(self):
+        """ (mtime, size, path) for every entry in the cache, size being
+        the disk actually taken, whole blocks, not the length of the json.
+        """
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except EnvironmentError:
+            return entries
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                info = os.stat(path)
+            except EnvironmentError:
+                continue
+            size = getattr(info, 'st_blocks', None)
+            if size is None:
+                size = -(-info.st_size // 4096) * 8
+            entries.append((info.st_mtime, size * 512, path))
+        return entries
+
+    def trim(self):
+        """ Drop least recently used entries until we fit in limit. """
+        entries = sorted(self._entries())
+        total = sum(size for _mtime, size, _path in entries)
+        while entries and total > self.limit:
+            _mtime, size, path = entries.pop(0)
+            total -= size
+            _remove(path)
+
+    def clear(self):
+        """ Throw away every entry. """
+        for _mtime, _size, path in self._entries():
+            _remove(path)
+
+
+def _remove(path):
+    """ Remove path, not minding if someone else beat us to it. """
+    try:
+        os.remove(path)
+    except EnvironmentError as Err:
+        if Err.errno != errno.ENOENT:
+            raise
+
+
+def _umask():
+    """ The process umask, which can only be had by setting it. """
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+def _atomic_write(path, data, binary=True, sync=False):
+    """ Write data, a string or an iterable of strings, to path by way of a
+    temp file in the same directory renamed into place, so nobody ever
+    sees half a file. mkstemp() makes the temp file 0600, it's given the
+    permissions any other new file would get before the rename. With sync
+    it's on disk before it replaces whatever was at path. """
+    import tempfile
+    handle, temp = tempfile.mkstemp(dir=os.path.dirname(
+        os.path.abspath(path)), suffix='.tmp')
+    output = os.fdopen(handle, 'wb' if binary else 'w')
+    try:
+        if isinstance(data, (bytes, _unicode_type)):
+            data = [data]
+        for part in data:
+            output.write(part)
+        if sync:
+            output.flush()
+            os.fsync(output.fileno())
+        output.close()
+        os.chmod(temp, 0o666 & ~_umask())
+        os.rename(temp, path)
+    except:
+        output.close()
+        _remove(temp)
+        raise
+    return path
+
+
+def parse_size(text):
+    """ Byte counts from the command line, with an optional K, M, G or T
+    suffix (powers of 1024). """
+    text = text.strip().upper().rstrip('B')
+    scale = 1
+    if text and text[-1] in 'KMGT':
+        scale = 1024 ** ('KMGT'.index(text[-1]) + 1)
+        text = text[:-1]
+    return int(text) * scale
+
+
+def parse_range(text):
+    """ START:END byte range, either end may be left off, both take size
+    suffixes. """
+    start, _sep, end = text.partition(':')
+    return (parse_size(start) if start else 0,
+            parse_size(end) if end else None)
+
+
+def build_index(filename, block=INDEX_BLOCK, index_file=None,
+                alphabet=good_symbols):
+    """ Write a prefix sum index for filename, the running count of each
+    symbol in alphabet at every block bytes, plus one last row at the end of
+    the file. With it the histogram of any byte range comes from two rows
+    and at most two partial blocks, see SymbolIndex. The index goes next
+    to the file as filename + INDEX_SUFFIX unless index_file says otherwise,
+    and records the file's size and mtime so a stale one can be spotted.
+    Returns the index path. """
+    log.debug('in build_index')
+    if index_file is None:
+        index_file = filename + INDEX_SUFFIX
+    info = os.stat(filename)
+    table = _byte_table(alphabet)
+    symbols = b''.join(needle for _value, needle in table)
+    rows = info.st_size // block + 1 + (1 if info.st_size % block else 0)
+    row = struct.Struct('<%dQ' % len(table))
+
+    def contents():
+        yield _INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, block,
+                                 info.st_size, rows, info.st_mtime,
+                                 len(symbols))
+        yield symbols
+        histogram = new_histogram()
+        yield row.pack(*[0] * len(table))
+        written = 1
+        for chunk in open_file(filename, chunk_size=block, decompress=False):
+            count_chunk(chunk, histogram, alphabet)
+            yield row.pack(*[histogram[value] for value, _needle in table])
+            written += 1
+        if written != rows:
+            raise ValueError('%s changed while it was being indexed' %
+                             filename)
+
+    _atomic_write(index_file, contents())
+    log.debug('leaving build_index')
+    return index_file
+
+
+class SymbolIndex(object):
+    """ A loaded prefix sum index, see build_index(). histogram(start, end)
+    gives the counts for any byte range without reading the whole file. """
 
-    data = _input.read().strip()
+    def __init__(self, filename, index_file=None):
+        if index_file is None:
+            index_file = filename + INDEX_SUFFIX
+        self.filename = filename
+        _input = open(index_file, 'rb')
+        try:
+            self._data = _input.read()
+        finally:
+            _input.close()
+        (magic, version, self.block, self.size, self.rows, self.mtime,
+         length) = _INDEX_HEADER.unpack_from(self._data, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError('%s is not a textmap index' % index_file)
+        start = _INDEX_HEADER.size
+        self.alphabet = self._data[start:start + length].decode('latin-1')
+        self._values = [ord(sym) for sym in self.alphabet]
+        self._row = struct.Struct('<%dQ' % length)
+        self._base = start + length
+        if len(self._data) != self._base + self.rows * self._row.size:
+            raise ValueError('%s is truncated' % index_file)
+
+    def fresh(self):
+        """ True if the file still has the size and mtime it was indexed
+        at. """
+        try:
+            info = os.stat(self.filename)
+        except EnvironmentError:
+            return False
+        return info.st_size == self.size and info.st_mtime == self.mtime
+
+    def _prefix(self, position):
+        """ Histogram of bytes [0, position), from the row at or below
+        position, topped up by scanning the partial block. """
+        row = min(position // self.block, self.rows - 1)
+        histogram = new_histogram()
+        counts = self._row.unpack_from(self._data,
+                                       self._base + row * self._row.size)
+        for value, count in zip(self._values, counts):
+            histogram[value] = count
+        if position > row * self.block:
+            count_chunks(open_file(self.filename, start=row * self.block,
+                                   end=position), histogram, self.alphabet)
+        return histogram
+
+    def histogram(self, start=0, end=None):
+        """ 256 entry histogram for bytes [start, end) of the file. """
+        if end is None or end > self.size:
+            end = self.size
+        start = max(0, min(start, end))
+        high = self._prefix(end)
+        low = self._prefix(start)
+        return [high[value] - low[value] for value in range(256)]
+
+
+def open_index(filename, block=INDEX_BLOCK, rebuild=False):
+    """ Load the index for filename, (re)building it first if there isn't
+    one, it is stale, or rebuild is asked for. """
+    index = None
+    if not rebuild:
+        try:
+            index = SymbolIndex(filename)
+        except (EnvironmentError, ValueError, struct.error) as Err:
+            log.debug('no usable index for %s, %s', filename, Err)
+    if index is None or not index.fresh():
+        log.debug('indexing %s every %d bytes', filename, block)
+        build_index(filename, block)
+        index = SymbolIndex(filename)
+    return index
+
+
+def sweep(filename, window, step, template, index=None):
+    """ Draw a map for every window bytes of filename, moving step bytes
+    along each time, each to its own output named from template (which
+    also gets {start} and {end}). Uses index for the counting, so no window
+    costs more than a couple of partial blocks. Returns the output names.
+    """
+    log.debug('in sweep')
+    if index is None:
+        index = open_index(filename)
+    outputs = []
+    start = 0
+    while True:
+        end = min(start + window, index.size)
+        output = output_name(template, filename, len(outputs), start=start,
+                             end=end)
+        draw_map(histogram_to_dict(index.histogram(start, end)), output)
+        outputs.append(output)
+        if end >= index.size:
+            break
+        start += step
+    log.debug('leaving sweep')
+    return outputs
+
+
+def block_entropy(chunks, block):
+    """ Shannon entropy, in bits per byte, of every block bytes of the data
+    in chunks (the last block may be short). This is over all 256 byte
+    values rather than the alphabet, so compressed or encrypted stretches
+    come out near 8 whatever they hold. A numpy float32 array with numpy,
+    a list without.
+
+    With numpy each batch of blocks is counted in one bincount(), every
+    byte offset by 256 times its block number, and the entropies come from
+    a table of c * log2(c) so there's no log taken per count either. """
+    log.debug('in block_entropy')
+    if get_backend() == 'numpy':
+        result = _block_entropy_numpy(chunks, block)
+    else:
+        result = _block_entropy_python(chunks, block)
+    log.debug('leaving block_entropy')
+    return result
+
+
+def _aligned(chunks, size):
+    """ Re-cut chunks into pieces that are a whole multiple of size bytes
+    (bar the last), whatever sizes they come in at. """
+    pending = b''
+    for chunk in chunks:
+        if not pending and len(chunk) % size == 0:
+            yield chunk
+            continue
+        pending += _as_bytes(chunk)
+        whole = len(pending) - len(pending) % size
+        if whole:
+            yield pending[:whole]
+            pending = pending[whole:]
+    if pending:
+        yield pending
+
+
+def _block_entropy_numpy(chunks, block):
+    import numpy as np
+    counted = np.arange(block + 1, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        clog = np.where(counted > 0, counted * np.log2(counted), 0.0)
+    results = []
+    for chunk in _aligned(chunks, block):
+        data = np.frombuffer(chunk, dtype=np.uint8)
+        whole = len(data) // block
+        if whole:
+            rows = data[:whole * block].reshape(whole, block).astype(np.intp)
+            rows += (np.arange(whole, dtype=np.intp) * 256)[:, None]
+            counts = np.bincount(rows.ravel(), minlength=whole * 256)
+            results.append(math.log(block, 2) - clog[counts].reshape(
+                whole, 256).sum(axis=1) / block)
+        if len(data) > whole * block:
+            tail = data[whole * block:]
+            counts = np.bincount(tail, minlength=256)
+            results.append(np.array([math.log(len(tail), 2) -
+                                     clog[counts].sum() / len(tail)]))
+    if not results:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(results).astype(np.float32)
+
+
+def _block_entropy_python(chunks, block):
+    results = []
+    for chunk in _aligned(chunks, block):
+        chunk = bytearray(_as_bytes(chunk))
+        for start in range(0, len(chunk), block):
+            piece = chunk[start:start + block]
+            size = float(len(piece))
+            results.append(0.0 - sum(count / size * math.log(count / size, 2)
+                                     for count in Counter(piece).values()))
+    return results
+
+
+def entropy_file(filename, block, use_mmap=True, decompress=True, jobs=1):
+    """ block_entropy() for every block of filename, read ENTROPY_BATCH
+    bytes (rounded to whole blocks, and at most ENTROPY_BATCH / 256
+    blocks) at a time. Like count_file(), big regular files are split
+    between jobs worker processes, on block boundaries so no block
+    straddles two of them. """
+    log.debug('in entropy_file')
+    size = 0
+    if filename != '-' and os.path.isfile(filename):
+        size = os.path.getsize(filename)
+    if jobs is None:
+        jobs = default_jobs()
+    started = time.time()
+    if (jobs <= 1 or size < PARALLEL_THRESHOLD or
+            (decompress and is_compressed(filename))):
+        entropies = entropy_range((filename, 0, None, block, use_mmap,
+                                   decompress))
+    else:
+        tasks = [(filename, start, end, block, use_mmap, False)
+                 for start, end in split_ranges(size, jobs, block)]
+        import multiprocessing
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        try:
+            results = pool.map(entropy_range, tasks)
+        finally:
+            pool.close()
+            pool.join()
+        if get_backend() == 'numpy':
+            import numpy as np
+            entropies = np.concatenate(results)
+        else:
+            entropies = [value for part in results for value in part]
+    metrics.add('entropy', time.time() - started, size)
+    log.debug('leaving entropy_file')
+    return entropies
+
+
+def entropy_range(task):
+    """ Worker side of entropy_file(), the block entropies for one byte
+    range. task is (filename, start, end, block, use_mmap, decompress). """
+    filename, start, end, block, use_mmap, decompress = task
+    # numpy counts a batch into 256 counters a block, so with small blocks
+    # it's the number of blocks that has to be kept down, not the bytes.
+    batch = max(1, ENTROPY_BATCH // max(block, 256)) * block
+    return block_entropy(open_file(filename, batch, use_mmap, start, end,
+                                   decompress), block)
+
+
+def dump_entropy(entropies, block, output_file):
+    """ Write entropies out, one 'offset entropy' line per block, or as a
+    numpy array if output_file ends in .npy. - is stdout. """
+    if output_file.endswith('.npy') and have_numpy():
+        import numpy as np
+        np.save(output_file, np.asarray(entropies, dtype=np.float32))
+        return
+    text = ''.join('%d %.4f\n' % (index * block, value)
+                   for index, value in enumerate(entropies))
+    if output_file == '-':
+        sys.stdout.write(text)
+    else:
+        write_output(output_file, text)
+
+
+def save_histogram(histogram, filename, source=None, alphabet=None):
+    """ Write histogram (a Histogram, or a 256 entry list reported over
+    alphabet) to filename in the compact binary format, a few bytes of
+    header and a fixed 8 byte counter per symbol. source is whatever should
+    be remembered about where the counts came from. Written to a temp file
+    and renamed into place, or to stdout for a filename of -. """
+    log.debug('in save_histogram')
+    if isinstance(histogram, Histogram):
+        alphabet = alphabet or histogram.alphabet
+        histogram = histogram.counts
+    table = _byte_table(alphabet or good_symbols)
+    symbols = b''.join(needle for _value, needle in table)
+    name = (source or '').encode('utf-8')
+    head = (_HIST_HEADER.pack(HIST_MAGIC, HIST_VERSION, len(symbols),
+                              len(name)) + symbols + name)
+    data = (head + b'\0' * (-len(head) % 8) +
+            struct.pack('<%dQ' % len(table),
+                        *[histogram[value] for value, _needle in table]))
+    if filename == '-':
+        getattr(sys.stdout, 'buffer', sys.stdout).write(data)
+        sys.stdout.flush()
+        log.debug('leaving save_histogram')
+        return filename
+    _atomic_write(filename, data)
+    log.debug('leaving save_histogram')
+    return filename
+
+
+class HistogramFile(object):
+    """ A histogram written by save_histogram(). The file is read in one go
+    and counts is a view straight onto the counters in it, nothing is
+    unpacked one at a time. """
+
+    def __init__(self, filename):
+        self.filename = filename
+        _input = open(filename, 'rb')
+        try:
+            self._data = _input.read()
+        finally:
+            _input.close()
+        magic, version, length, name = _HIST_HEADER.unpack_from(self._data, 0)
+        if magic != HIST_MAGIC or version != HIST_VERSION:
+            raise ValueError('%s is not a textmap histogram' % filename)
+        start = _HIST_HEADER.size
+        self.alphabet = self._data[start:start + length].decode('latin-1')
+        start += length
+        self.source = self._data[start:start + name].decode('utf-8')
+        start += name
+        self._base = start + (-start % 8)
+        if len(self._data) != self._base + 8 * length:
+            raise ValueError('%s is truncated' % filename)
+        self.counts = _counters(self._data, self._base, length)
+
+    def histogram(self):
+        """ The counts as a 256 entry histogram. """
+        histogram = new_histogram()
+        for (value, _needle), count in _izip(_byte_table(self.alphabet),
+                                             self.counts):
+            histogram[value] = count
+        return histogram
+
+
+def _counters(data, offset, length):
+    """ length little endian 64 bit counters from data at offset. A cast
+    memoryview where the machine is little endian and python 3 has cast(),
+    an array copy otherwise. """
+    view = memoryview(data)[offset:offset + 8 * length]
+    if sys.byteorder == 'little' and hasattr(view, 'cast'):
+        return view.cast('Q')
+    if hasattr(view, 'cast'):
+        import array
+        counts = array.array('Q', view.tobytes())
+        counts.byteswap()
+        return counts
+    return struct.unpack_from('<%dQ' % length, data, offset)
+
+
+def merge_histograms(filenames):
+    """ Sum the histogram files in filenames into one Histogram. Files over
+    the same alphabet as the first (the usual case, shards all counted the
+    same way) are summed straight off the counter views, so this runs at
+    about the speed the files can be read. numpy was tried here and lost,
+    at 62 counters a file its per call overhead is most of the work. Other
+    alphabets are added symbol by symbol, dropping any symbols the first
+    doesn't have. Unreadable files are skipped with a warning. Returns the
+    Histogram and the number of files that went into it. """
+    log.debug('in merge_histograms')
+    total = None
+    alphabet = None
+    merged = 0
+    rest = Histogram(alphabet=good_symbols)
+    with metrics.stage('merge'):
+        for filename in filenames:
+            try:
+                shard = HistogramFile(filename)
+            except (EnvironmentError, ValueError, struct.error) as Err:
+                log.warning('skipping %s, %s', filename, Err)
+                continue
+            merged += 1
+            if alphabet is None:
+                alphabet = shard.alphabet
+                rest = Histogram(alphabet=alphabet)
+            if shard.alphabet != alphabet:
+                rest.merge(shard.histogram())
+                continue
+            if total is None:
+                total = list(shard.counts)
+            else:
+                total = [mine + theirs
+                         for mine, theirs in _izip(total, shard.counts)]
+    if total is not None:
+        for (value, _needle), count in _izip(_byte_table(alphabet), total):
+            rest.counts[value] += count
+    log.debug('leaving merge_histograms')
+    return rest, merged
+
+
+def read_listing(listing):
+    """ Pull input paths out of a listing file, one per line. Blank lines
+    and lines starting with # are skipped. """
+    paths = []
+    _input = open(listing)
+    for line in _input:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            paths.append(line)
     _input.close()
-    #size = len(data)
-    log.debug('leaving open_file')
-    return data
+    return paths
+
+
+def output_name(template, path, index, **extra):
+    """ Fill in an output name template for one input path. Available
+    fields are {name} (base name), {stem} (base name less extension), {dir}
+    (the input's directory) and {index} (position in the batch), plus
+    whatever else the caller passes in extra. """
+    name = os.path.basename(path)
+    return template.format(name=name, stem=os.path.splitext(name)[0],
+                           dir=os.path.dirname(path) or '.', index=index,
+                           **extra)
+
+
+class BatchTimeout(Exception):
+    """ A batch input ran past its time limit. """
+    pass
+
+
+def _alarm(signum, frame):
+    """ SIGALRM handler for batch workers. """
+    raise BatchTimeout('timed out')
+
+
+def _batch_init(backend, level):
+    """ Runs once in each batch worker, so the per file work doesn't pay
+    for any setup. Workers leave ctrl-c to the parent. """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(signal, 'SIGALRM'):
+        signal.signal(signal.SIGALRM, _alarm)
+    set_backend(backend)
+    log.setLevel(level)
+
+
+def render_one(task):
+    """ Batch worker, count one input and write its map. Never raises,
+    failures come back as the error string so one bad file can't take the
+    rest of the batch with it. task is (path, output, use_mmap, timeout,
+    cache). """
+    path, output, use_mmap, timeout, cache = task
+    started = time.time()
+    error = None
+    if timeout and hasattr(signal, 'alarm'):
+        signal.alarm(int(math.ceil(timeout)))
+    try:
+        histogram = count_file(path, jobs=1, use_mmap=use_mmap, cache=cache)
+        draw_map(histogram_to_dict(histogram), output)
+    except Exception as Err:
+        error = '%s: %s' % (Err.__class__.__name__, Err)
+    finally:
+        if timeout and hasattr(signal, 'alarm'):
+            signal.alarm(0)
+    return path, output, error, time.time() - started
+
+
+def run_batch(paths, template, jobs=None, use_mmap=True, timeout=None,
+              cache=None):
+    """ Render every path in paths to its own output, named from template,
+    over a pool of worker processes. Prints a line per input and a summary
+    at the end, and returns the number of failures. """
+    log.debug('in run_batch')
+    tasks = []
+    outputs = {}
+    for index, path in enumerate(paths):
+        output = output_name(template, path, index)
+        if output in outputs:
+            log.error('%s and %s would both be written to %s, add {index} '
+                      'or {dir} to the output template', outputs[output],
+                      path, output)
+            return len(paths)
+        outputs[output] = path
+        tasks.append((path, output, use_mmap, timeout, cache))
+    if jobs is None:
+        jobs = default_jobs()
+    import multiprocessing
+    pool = multiprocessing.Pool(max(1, min(jobs, len(tasks))), _batch_init,
+                                (get_backend(), log.getEffectiveLevel()))
+    failed = 0
+    try:
+        for path, output, error, elapsed in pool.imap_unordered(render_one,
+                                                                 tasks):
+            if error:
+                failed += 1
+                sys.stdout.write('FAIL %s (%s) %.2fs\n' % (path, error,
+                                                          elapsed))
+            else:
+                sys.stdout.write('ok   %s -> %s %.2fs\n' % (path, output,
+                                                           elapsed))
+    finally:
+        pool.close()
+        pool.join()
+    sys.stdout.write('%d of %d rendered, %d failed\n' %
+                     (len(tasks) - failed, len(tasks), failed))
+    log.debug('leaving run_batch')
+    return failed
+
+
+def run_combined(paths, output_file=None, per_page=1, jobs=None,
+                 use_mmap=True, cache=None):
+    """ Like run_batch(), but every map goes into the one document,
+    output_file, per_page maps to a page. Inputs are counted over a pool of
+    workers and drawn in the order given as they come back. Returns the
+    number of failures. """
+    log.debug('in run_combined')
+    tasks = [(path, use_mmap, cache) for path in paths]
+    if jobs is None:
+        jobs = default_jobs()
+    pool = None
+    if jobs <= 1 or len(tasks) <= 1:
+        results = (count_one(task) for task in tasks)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(jobs, len(tasks)), _batch_init,
+                                    (get_backend(), log.getEffectiveLevel()))
+        results = pool.imap(count_one, tasks)
+    failures = []
+
+    def counted():
+        for path, histogram, error in results:
+            if error:
+                failures.append(path)
+                sys.stdout.write('FAIL %s (%s)\n' % (path, error))
+                continue
+            yield path, histogram_to_dict(histogram)
+
+    try:
+        pages = draw_maps(counted(), output_file, per_page)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    sys.stdout.write('%d of %d drawn on %d pages of %s, %d failed\n' %
+                     (len(tasks) - len(failures), len(tasks), pages,
+                      output_file or DEFAULT_OUTPUT, len(failures)))
+    log.debug('leaving run_combined')
+    return len(failures)
+
+
+def count_one(task):
+    """ Compare worker, the histogram for one input. Like render_one()
+    failures come back as a string rather than raised. task is (path,
+    use_mmap, cache), and optionally the jobs to split the file over when
+    it's counted in the main process. """
+    path, use_mmap, cache = task[:3]
+    jobs = task[3] if len(task) > 3 else 1
+    try:
+        return path, count_file(path, jobs=jobs, use_mmap=use_mmap,
+                                cache=cache), None
+    except Exception as Err:
+        return path, None, '%s: %s' % (Err.__class__.__name__, Err)
+
+
+def count_many(paths, jobs=None, use_mmap=True, cache=None):
+    """ Histograms for every path, counted over a pool of worker processes.
+    Returns the paths that could be counted and their histograms, in the
+    order given, warning about the ones that couldn't. """
+    log.debug('in count_many')
+    tasks = [(path, use_mmap, cache) for path in paths]
+    if jobs is None:
+        jobs = default_jobs()
+    if jobs <= 1 or len(tasks) <= 1:
+        results = [count_one(task) for task in tasks]
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(jobs, len(tasks)), _batch_init,
+                                    (get_backend(), log.getEffectiveLevel()))
+        try:
+            results = pool.map(count_one, tasks, chunksize=max(
+                1, len(tasks) // (jobs * 4)))
+        finally:
+            pool.close()
+            pool.join()
+    counted = []
+    histograms = []
+    for path, histogram, error in results:
+        if error:
+            log.warning('skipping %s, %s', path, error)
+            continue
+        counted.append(path)
+        histograms.append(histogram)
+    log.debug('leaving count_many')
+    return counted, histograms
+
+
+class _Entry(object):
+    """ Just enough of os.DirEntry for walk_files(), where python has no
+    os.scandir() (python 2). """
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+    def is_dir(self, follow_symlinks=True):
+        if not follow_symlinks and self.is_symlink():
+            return False
+        return os.path.isdir(self.path)
+
+    def stat(self, follow_symlinks=True):
+        return os.stat(self.path) if follow_symlinks else os.lstat(self.path)
+
+
+def _scandir(directory):
+    """ os.scandir(), or a listdir() stand in for it. """
+    if hasattr(os, 'scandir'):
+        return list(os.scandir(directory))
+    return [_Entry(directory, name) for name in os.listdir(directory)]
+
+
+def _wanted(name, include, exclude):
+    """ True if name passes the include and exclude glob patterns. """
+    import fnmatch
+    if any(fnmatch.fnmatch(name, pattern) for pattern in exclude or ()):
+        return False
+    return not include or any(fnmatch.fnmatch(name, pattern)
+                              for pattern in include)
+
+
+def walk_files(root, include=None, exclude=None, follow_links=False,
+               seen=None, match=None):
+    """ Yield (path, size) for every regular file under root, depth first,
+    in name order. include and exclude are lists of glob patterns matched
+    against file names, exclude also prunes whole directories. Symlinked
+    directories are only gone into with follow_links, and every directory
+    and file is visited once at most (by device and inode), so a symlink
+    loop can't send us round forever and a hard linked file is only counted
+    the once. seen is the set of (device, inode) to check against, pass the
+    same one to several walks to keep them from overlapping. match, if
+    given, is one more test for each file's path to pass. Unreadable
+    directories are warned about and skipped. """
+    if seen is None:
+        seen = set()
+    pending = [root]
+    while pending:
+        directory = pending.pop()
+        try:
+            info = os.stat(directory)
+        except EnvironmentError as Err:
+            log.warning('skipping %s, %s', directory, Err)
+            continue
+        if (info.st_dev, info.st_ino) in seen:
+            log.debug('already been in %s, not going round again',
+                      directory)
+            continue
+        seen.add((info.st_dev, info.st_ino))
+        try:
+            entries = sorted(_scandir(directory), key=lambda e: e.name)
+        except EnvironmentError as Err:
+            log.warning('skipping %s, %s', directory, Err)
+            continue
+        subdirectories = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=follow_links):
+                    if _wanted(entry.name, None, exclude):
+                        subdirectories.append(entry.path)
+                    continue
+                if entry.is_symlink() and not follow_links:
+                    continue
+                info = entry.stat()
+            except EnvironmentError as Err:
+                log.debug('skipping %s, %s', entry.path, Err)
+                continue
+            if stat.S_ISREG(info.st_mode) and _wanted(entry.name, include,
+                                                      exclude):
+                if ((info.st_dev, info.st_ino) in seen or
+                        (match is not None and not match(entry.path))):
+                    continue
+                seen.add((info.st_dev, info.st_ino))
+                yield entry.path, info.st_size
+        pending.extend(reversed(subdirectories))
+
+
+def is_corpus(name):
+    """ True if name is a directory, or a glob pattern rather than a file,
+    i.e. something for scan_corpus(). """
+    import glob
+    if name == '-':
+        return False
+    return os.path.isdir(name) or (not os.path.exists(name) and
+                                   glob.has_magic(name))
+
+
+def corpus_files(name, include=None, exclude=None, follow_links=False):
+    """ (path, size) for every file a directory or glob pattern name stands
+    for. Directories, named or matched, are walked with walk_files(), all
+    sharing the one seen set so no file comes up twice. A ** in the
+    pattern matches any number of directories, and is done by walking
+    rather than by glob, so it minds follow_links and symlink loops too. """
+    import glob
+    seen = set()
+    if '**' in name.split('/'):
+        for found in _deep_glob(name, include, exclude, follow_links, seen):
+            yield found
+        return
+    roots = [name] if os.path.isdir(name) else sorted(glob.glob(name))
+    for root in roots:
+        if os.path.isdir(root):
+            for found in walk_files(root, include, exclude, follow_links,
+                                    seen):
+                yield found
+            continue
+        try:
+            info = os.stat(root)
+        except EnvironmentError:
+            continue
+        if (stat.S_ISREG(info.st_mode) and
+                (info.st_dev, info.st_ino) not in seen and
+                _wanted(os.path.basename(root), include, exclude)):
+            seen.add((info.st_dev, info.st_ino))
+            yield root, info.st_size
+
+
+def _deep_glob(pattern, include, exclude, follow_links, seen):
+    """ corpus_files() for a pattern with ** in it. Everything under the
+    part of the pattern before the first wildcard is walked, and the files
+    that match the rest, or sit in a directory that does, are kept. """
+    import glob
+    parts = pattern.split('/')
+    fixed = 0
+    while fixed < len(parts) - 1 and not glob.has_magic(parts[fixed]):
+        fixed += 1
+    base = '/'.join(parts[:fixed]) or ('/' if pattern.startswith('/')
+                                       else '.')
+    wild = parts[fixed:]
+
+    def matches(path):
+        found = os.path.relpath(path, base).split(os.sep)
+        return any(_match_parts(found[:end], wild)
+                   for end in range(len(found), 0, -1))
+
+    for path, size in walk_files(base, include, exclude, follow_links, seen,
+                                 matches):
+        yield (path if base != '.' else os.path.relpath(path)), size
+
+
+def _match_parts(names, patterns):
+    """ True if the path components names match the glob components
+    patterns, a ** standing for any number of them. Like glob, wildcards
+    don't match names starting with a dot unless the pattern does. """
+    import fnmatch
+    if not patterns:
+        return not names
+    if patterns[0] == '**':
+        return any(_match_parts(names[skip:], patterns[1:])
+                   for skip in range(len(names) + 1)
+                   if not any(name.startswith('.')
+                              for name in names[:skip]))
+    if not names:
+        return False
+    if names[0].startswith('.') and not patterns[0].startswith('.'):
+        return False
+    return (fnmatch.fnmatchcase(names[0], patterns[0]) and
+            _match_parts(names[1:], patterns[1:]))
+
+
+class Progress(object):
+    """ Running count of files and bytes done, written over itself on
+    stream at most every interval seconds. """
+
+    def __init__(self, stream=None, interval=0.5):
+        self.stream = stream
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self.failed = 0
+        self.resumed = 0
+        self.started = time.time()
+        self._shown = 0
+
+    def add(self, size, failed=False):
+        self.files += 1
+        self.bytes += size
+        self.failed += failed
+        if self.stream and time.time() - self._shown >= self.interval:
+            self.show()
+
+    def line(self):
+        elapsed = max(time.time() - self.started, 1e-9)
+        return '%d files, %s, %.1f MB/s%s%s' % (
+            self.files, format_size(self.bytes), self.bytes / elapsed / 1e6,
+            ', %d failed' % self.failed if self.failed else '',
+            ', %d from the checkpoint' % self.resumed if self.resumed else '')
+
+    def show(self, end=''):
+        self._shown = time.time()
+        self.stream.write('\r' + self.line() + end)
+        self.stream.flush()
+
+    def done(self):
+        if self.stream:
+            self.show('\n')
+
+
+def scan_corpus(files, jobs=None, use_mmap=True, cache=None, per_file=None,
+                progress=None, checkpoint=None, resume=False, source=None):
+    """ Count every (path, size) in files, as walk_files() gives them, over
+    a pool of jobs worker processes, and sum them into one Histogram. The
+    files are handed out one at a time, so even a few of them keep all the
+    workers busy, and results are taken as they finish. A file of
+    PARALLEL_THRESHOLD or more waits for the pool to run dry and is then
+    split across all jobs by count_file(), one big file in a corpus of
+    small ones would otherwise keep a single worker busy long after the
+    rest are done.
+
+    per_file, if given, is an output name template (see output_name()) to
+    save each file's own histogram to, in the binary format. {index} is
+    the file's position in files, so it doesn't depend on which worker
+    finishes first. A file whose name comes out the same as an earlier
+    one's isn't saved, it's counted as failed rather than overwrite the
+    other one. progress is a Progress to report to. Returns the total
+    Histogram and the Progress.
+
+    With a Checkpoint the running total and how far through files we are
+    are saved to it as we go, under source, whatever names the corpus.
+    files has to come in the same order every time, as walk_files() does,
+    since all that's kept is the position every file before which is done
+    plus the few past it that finished early, and the per_file names used
+    so far. With resume those are skipped and their counts taken from the
+    checkpoint instead. """
+    log.debug('in scan_corpus')
+    if progress is None:
+        progress = Progress()
+    total = Histogram()
+    sizes = {}
+    saved = {}
+    positions = {}
+    # Every file before mark is done, finished maps the position of each
+    # one past it that's done too to its path, and last is the path of the
+    # file just before mark.
+    where = {'mark': 0, 'last': None}
+    finished = {}
+    files = iter(files)
+    ahead = []
+    state = checkpoint.resume(source) if resume and checkpoint else None
+    if state is not None:
+        total.merge(state['histogram'])
+        where.update(mark=state['mark'], last=state['last'])
+        saved.update(state['saved'])
+        progress.failed = state['failed']
+        progress.resumed = where['mark'] + len(state['finished'])
+        path = None
+        for _position, (path, _size) in _izip(range(where['mark']), files):
+            pass
+        if path != where['last']:
+            raise ValueError('the files have changed since the checkpoint')
+        # Read on past the ones that finished early, so their names are
+        # known, keeping the rest to hand out first.
+        finished = dict((position, None) for position in state['finished'])
+        for position in range(where['mark'],
+                              max(state['finished'] or [-1]) + 1):
+            try:
+                path, size = next(files)
+            except StopIteration:
+                raise ValueError('the files have changed since the '
+                                 'checkpoint')
+            if position in finished:
+                finished[position] = path
+            else:
+                ahead.append((position, path, size))
+
+    start = where['mark'] + len(finished) + len(ahead)
+    pending = itertools.chain(ahead, ((position, path, size)
+                                      for position, (path, size)
+                                      in enumerate(files, start)))
+    if jobs is None:
+        jobs = default_jobs()
+
+    def tasks(big):
+        # Up to the next big file, which is left in big for results().
+        for position, path, size in pending:
+            sizes[path] = size
+            positions[path] = position
+            if jobs > 1 and size >= PARALLEL_THRESHOLD:
+                big.append(path)
+                return
+            yield (path, use_mmap, cache)
+
+    def results():
+        while True:
+            big = []
+            if pool is not None:
+                for result in pool.imap_unordered(count_one, tasks(big),
+                                                  chunksize=1):
+                    yield result
+            else:
+                for task in tasks(big):
+                    yield count_one(task)
+            if not big:
+                return
+            yield count_one((big[0], use_mmap, cache, jobs))
+
+    def done(position, path):
+        finished[position] = path
+        while where['mark'] in finished:
+            where['last'] = finished.pop(where['mark'])
+            where['mark'] += 1
+
+    def save():
+        checkpoint.save(source=source, mark=where['mark'],
+                        finished=sorted(finished), last=where['last'],
+                        saved=saved, failed=progress.failed,
+                        histogram=total.counts)
+
+    pool = None
+    if jobs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs, _batch_init,
+                                    (get_backend(), log.getEffectiveLevel()))
+    try:
+        for path, histogram, error in results():
+            size = sizes.pop(path, 0)
+            position = positions.pop(path)
+            progress.add(size, bool(error))
+            if error:
+                log.warning('skipping %s, %s', path, error)
+            else:
+                total.merge(histogram)
+            if per_file and not error:
+                output = output_name(per_file, path, position)
+                if output in saved:
+                    log.error('%s and %s would both be saved to %s, add '
+                              '{index} to the --per-file template',
+                              saved[output], path, output)
+                    progress.failed += 1
+                else:
+                    saved[output] = path
+                    save_histogram(histogram, output, source=path)
+            if checkpoint is not None:
+                done(position, path)
+                if checkpoint.due(size):
+                    save()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        progress.done()
+    if checkpoint is not None:
+        checkpoint.remove()
+    log.debug('leaving scan_corpus')
+    return total, progress
+
+
+def symbol_matrix(histograms, alphabet=good_symbols):
+    """ Stack histograms (256 entry lists or Histograms) into one row per
+    input, one column per symbol of alphabet. A numpy array when numpy is
+    about, lists of lists otherwise. """
+    columns = [value for value, _needle in _byte_table(alphabet)]
+    rows = [(item.counts if isinstance(item, Histogram) else item)
+            for item in histograms]
+    if get_backend() == 'numpy':
+        import numpy as np
+        matrix = np.asarray(rows, dtype=np.float64).reshape(len(rows), 256)
+        return matrix[:, columns]
+    return [[float(row[value]) for value in columns] for row in rows]
 
 
-def massage(data):
-    """ Pass the data, one big string, to build_list, get a dict back."""
+def compare(matrix, reference=None):
+    """ Statistics for each row of a symbol_matrix(), which is what tells
+    plaintext from random data or ciphertext. Returns a dict of
+
+        symbols   how many symbols each row has
+        entropy   Shannon entropy, bits per symbol
+        ioc       index of coincidence, the chance two symbols picked at
+                  random are the same
+        chi2      chi squared against reference, a list of symbol counts
+                  or frequencies (every symbol equally likely if None),
+                  symbols the reference never has are left out
+        distance  N x N Hellinger distances between the rows' frequencies,
+                  0 for the same mix of symbols up to 1 for nothing shared
+
+    with None where a row has too few symbols for it to mean anything.
+    Everything is done across the whole matrix at once with numpy, without
+    it a plain python version does the same sums, slowly. """
+    log.debug('in compare')
+    if get_backend() == 'numpy':
+        stats = _compare_numpy(matrix, reference)
+    else:
+        stats = _compare_python(matrix, reference)
+    log.debug('leaving compare')
+    return stats
+
+
+def _reference_freqs(reference, width):
+    """ reference as frequencies summing to 1, uniform if it's None. """
+    if reference is None:
+        return [1.0 / width] * width
+    total = float(sum(reference))
+    if not total:
+        raise ValueError('the reference has no symbols in it')
+    return [count / total for count in reference]
+
+
+def _compare_numpy(matrix, reference):
+    import numpy as np
+    counts = np.asarray(matrix, dtype=np.float64)
+    rows, width = counts.shape
+    expect = np.asarray(_reference_freqs(reference, width))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        totals = counts.sum(axis=1)
+        freqs = counts / totals[:, None]
+        logs = np.where(counts > 0, np.log2(freqs), 0.0)
+        entropy = 0.0 - (np.where(counts > 0, freqs, 0.0) * logs).sum(axis=1)
+        ioc = (counts * (counts - 1)).sum(axis=1) / (totals * (totals - 1))
+        used = expect > 0
+        expected = totals[:, None] * expect[used]
+        chi2 = ((counts[:, used] - expected) ** 2 / expected).sum(axis=1)
+        roots = np.sqrt(np.nan_to_num(freqs))
+    # Hellinger, sqrt(1 - sum(sqrt(p * q))), the sum being a matrix product.
+    distance = np.sqrt(np.clip(1.0 - roots.dot(roots.T), 0.0, 1.0))
+    empty = totals == 0
+    distance[empty, :] = np.nan
+    distance[:, empty] = np.nan
+    np.fill_diagonal(distance, 0.0)
+
+    def listed(values, bad):
+        return [None if flag else float(value)
+                for value, flag in _izip(values.tolist(), bad.tolist())]
+    distances = distance.tolist()
+    if empty.any():
+        distances = [[None if value != value else value for value in row]
+                     for row in distances]
+    return {'symbols': [int(total) for total in totals.tolist()],
+            'entropy': listed(entropy, empty),
+            'ioc': listed(ioc, totals < 2),
+            'chi2': listed(chi2, empty),
+            'distance': distances}
+
+
+def _compare_python(matrix, reference):
+    width = len(matrix[0]) if matrix else len(good_symbols)
+    expect = _reference_freqs(reference, width)
+    stats = {'symbols': [], 'entropy': [], 'ioc': [], 'chi2': [],
+             'distance': []}
+    roots = []
+    for counts in matrix:
+        total = sum(counts)
+        stats['symbols'].append(int(total))
+        if not total:
+            roots.append(None)
+            for name in ('entropy', 'ioc', 'chi2'):
+                stats[name].append(None)
+            continue
+        freqs = [count / total for count in counts]
+        roots.append([math.sqrt(freq) for freq in freqs])
+        stats['entropy'].append(0.0 - sum(freq * math.log(freq, 2)
+                                          for freq in freqs if freq))
+        stats['ioc'].append(sum(count * (count - 1) for count in counts) /
+                            (total * (total - 1)) if total > 1 else None)
+        stats['chi2'].append(sum((count - total * freq) ** 2 / (total * freq)
+                                 for count, freq in _izip(counts, expect)
+                                 if freq))
+    for row, mine in enumerate(roots):
+        line = []
+        for column, theirs in enumerate(roots):
+            if row == column:
+                line.append(0.0)
+            elif mine is None or theirs is None:
+                line.append(None)
+            else:
+                shared = sum(a * b for a, b in _izip(mine, theirs))
+                line.append(math.sqrt(min(max(1.0 - shared, 0.0), 1.0)))
+        stats['distance'].append(line)
+    return stats
+
+
+def format_report(paths, stats, report='table'):
+    """ The comparison from compare() as text, either a table per input
+    followed by the distance matrix, or json. """
+    if report == 'json':
+        import json
+        return json.dumps({'inputs': [dict(path=path, symbols=symbols,
+                                           entropy=entropy, ioc=ioc, chi2=chi2)
+                                      for path, symbols, entropy, ioc, chi2
+                                      in zip(paths, stats['symbols'],
+                                             stats['entropy'], stats['ioc'],
+                                             stats['chi2'])],
+                           'distance': stats['distance']},
+                          sort_keys=True) + '\n'
+
+    def cell(value, spec):
+        return '-' if value is None else spec % value
+    lines = ['%4s %12s %8s %8s %14s  %s' % ('#', 'symbols', 'entropy', 'ioc',
+                                           'chi2', 'input')]
+    for index, path in enumerate(paths):
+        lines.append('%4d %12d %8s %8s %14s  %s' % (
+            index, stats['symbols'][index],
+            cell(stats['entropy'][index], '%.4f'),
+            cell(stats['ioc'][index], '%.5f'),
+            cell(stats['chi2'][index], '%.1f'), path))
+    lines.append('')
+    lines.append('hellinger distance')
+    lines.append('%4s ' % '' + ' '.join('%6d' % index
+                                        for index in range(len(paths))))
+    for index, row in enumerate(stats['distance']):
+        lines.append('%4d ' % index + ' '.join(cell(value, '%6.4f').rjust(6)
+                                               for value in row))
+    return '\n'.join(lines) + '\n'
+
+
+def run_compare(paths, reference=None, report='table', jobs=None,
+                use_mmap=True, cache=None):
+    """ Count every path, compare them and print the report. reference is
+    a file whose symbol frequencies the chi squared is taken against.
+    Returns the number of inputs that couldn't be counted, or all of them
+    when the reference has nothing to compare against. """
+    log.debug('in run_compare')
+    counted, histograms = count_many(paths, jobs, use_mmap, cache)
+    expect = None
+    if reference is not None:
+        expect = symbol_matrix([count_file(reference, use_mmap=use_mmap,
+                                           cache=cache)])[0]
+        expect = list(expect)
+    try:
+        with metrics.stage('compare'):
+            stats = compare(symbol_matrix(histograms), expect)
+    except ValueError:
+        log.error('reference %s has no symbols', reference)
+        return len(paths)
+    sys.stdout.write(format_report(counted, stats, report))
+    log.debug('leaving run_compare')
+    return len(paths) - len(counted)
+
+
+def follow(filename, output_file=None, interval=2.0, every=None,
+           poll=0.5):
+    """ Like tail -f. Count the file, then keep watching it and count only
+    the bytes appended since last time into the running histogram. The map
+    is redrawn once new data has been waiting interval seconds, or as soon
+    as every bytes of it have come in. A file that shrinks, or is replaced
+    by a different file (rotation), resets the histogram and starts over
+    from the top. Runs until interrupted. """
+    log.debug('in follow')
+    histogram = new_histogram()
+    offset = 0
+    identity = None
+    pending = 0
+    last_draw = time.time()
+    try:
+        while True:
+            try:
+                info = os.stat(filename)
+            except EnvironmentError as Err:
+                # Mid rotation, most likely. Wait for the new one.
+                log.debug('cannot stat %s, %s', filename, Err)
+                time.sleep(poll)
+                continue
+            if identity is not None and ((info.st_dev, info.st_ino) !=
+                                         identity or info.st_size < offset):
+                log.warning('%s was truncated or rotated, starting over',
+                            filename)
+                histogram = new_histogram()
+                offset = 0
+                pending = max(pending, 1)
+            identity = (info.st_dev, info.st_ino)
+            if info.st_size > offset:
+                counted = count_chunks(open_file(filename, use_mmap=False,
+                                                 start=offset,
+                                                 end=info.st_size), histogram)
+                offset += counted
+                pending += counted
+            now = time.time()
+            if pending and ((every and pending >= every) or
+                            now - last_draw >= interval):
+                log.debug('redrawing at offset %d', offset)
+                draw_map(histogram_to_dict(histogram), output_file)
+                pending = 0
+                last_draw = now
+            time.sleep(poll)
+    except KeyboardInterrupt:
+        if pending:
+            draw_map(histogram_to_dict(histogram), output_file)
+    log.debug('leaving follow')
+    return histogram
+
+
+def massage(data, output_file=None):
+    """ Pass the data, a string or an iterable of chunks, to build_list,
+    get a dict back, and draw it to output_file (--output if not given)."""
     log.debug('in massage')
     symbols_used = build_list(data)
-    size = len(symbols_used.keys())
-    char_sep = 360.0 / size  # Deg seperation between symbols on chart.
+    draw_map(symbols_used, output_file)
+    log.debug('leaving massage')
+
+
+def draw_map(symbols_used, output_file=None, note=None):
+    """ Take the char:number dict from build_list(), or a Histogram, and
+    turn it into the postscript map, written to output_file (a path or a
+    file like object, DEFAULT_OUTPUT if not given). note is a line of text
+    printed under the map."""
+    log.debug('in draw_map')
 
 # The Postscript stuff. Hand off the data, and the xy coords to be
 # written into the postscript file.
 
-    rect_coords = build_coords(symbols_used, char_sep)
-    build_postscript(rect_coords)
+    with metrics.stage('layout'):
+        rect_coords = coordinates(symbols_used)
+    build_postscript(rect_coords, output_file, note)
 
 # Supporting functions.
-    log.debug('leaving massage')
+    log.debug('leaving draw_map')
+
+
+def coordinates(symbols_used):
+    """ Rect coords for every symbol, from a char:number dict, a Histogram
+    or a SymbolCounter, spread evenly round the circle. """
+    if isinstance(symbols_used, (Histogram, SymbolCounter)):
+        symbols_used = symbols_used.as_dict()
+    size = len(symbols_used.keys()) or 1
+    char_sep = 360.0 / size  # Deg seperation between symbols on chart.
+    return build_coords(symbols_used, char_sep)
 
 
 def radme(deg, func):
@@ -196,33 +3228,368 @@ def radme(deg, func):
         deg_real = math.sin(deg * math.pi / 180)
     return deg_real
 
-def build_postscript(rect_coords):
+def build_postscript(rect_coords, output_file=None, note=None):
     """ We have to take the frequency of symbol use value in symbol_dict, and
  convert that first to a polar radius value, (using char_sep, and
  incrementing it for the angle) then convert that polar coord pair,
- into rect coords for postscript. """
+ into rect coords for postscript. Written to output_file, a path or
+ anything with a write() method, DEFAULT_OUTPUT if that isn't given. """
     log.debug('in build_postscript')
-    output_file = args.output
-    output = open(output_file, 'w')
+    if output_file is None:
+        output_file = DEFAULT_OUTPUT
+    write_output(output_file, postscript_page(rect_coords, note))
+    log.debug('leaving build_postscript')
+
+
+def postscript_page(rect_coords, note=None):
+    """ The whole postscript document for one map, built in memory so it
+ can go out in a single write, or back to a caller that wants the text.
+ note, if there is one, goes along the bottom of the page. Any number of
+ symbols will do, past the usual 62 the labels get smaller to suit. """
+    started = time.time()
+    page = [header(), crosshair(), map_marks(rect_coords, note),
+            ' showpage \r']
+    page = ''.join(page)
+    metrics.add('render', time.time() - started, len(page))
+    return page
 
-#  Build the postscript file, which for now, appears on stdout.
-    output.write(header())
-    output.write(crosshair())
+
+def map_marks(rect_coords, note=None):
+    """ The marks for one map, the note and the symbols, drawn round an
+ origin already in the middle of the crosshair. """
+    marks = []
+    if note:
+        marks.append(' -1 cal -1.3 cal moveto (%s) show ' % ps_escape(note))
+    marks.append(label_font(rect_coords))
     for sym in rect_coords.keys():
         X, Y = rect_coords[sym]
         log.debug("X and Y are %3.8f and %3.8f", X, Y)
         if X and Y != 0.00000000:
-            output.write('%3.8f cal  %3.8f cal moveto (%s) show ' % (X, Y, sym))
+            marks.append('%3.8f cal  %3.8f cal moveto (%s) show ' %
+                         (X, Y, ps_label(sym)))
         else:
             log.debug("zero count for symbol %s", sym)
-    output.write(' showpage \r')
-    output.close()
-    log.debug('leaving build_postscript')
+    return ''.join(marks)
+
+
+def draw_maps(maps, output_file=None, per_page=1):
+    """ Like draw_map() but for any number of maps in one document. maps
+ is an iterable of (title, symbols) pairs, symbols being anything
+ draw_map() takes, and is worked through as it comes so it can be a
+ generator over thousands of inputs. Returns the number of pages. """
+    log.debug('in draw_maps')
+
+    def laid_out():
+        for title, symbols_used in maps:
+            with metrics.stage('layout'):
+                rect_coords = coordinates(symbols_used)
+            yield title, rect_coords
+    pages = build_document(laid_out(), output_file, per_page)
+    log.debug('leaving draw_maps')
+    return pages
+
+
+def build_document(maps, output_file=None, per_page=1):
+    """ One postscript document holding every map in maps, an iterable of
+ (title, rect_coords) pairs, per_page of them to a page as a grid of
+ small multiples, or a full page each when per_page is 1. The font,
+ /cal and /crosshair are defined once in the prolog rather than per map,
+ and each page is put together in memory and goes out in one write, so
+ the output is opened once however many maps there are. """
+    log.debug('in build_document')
+    if output_file is None:
+        output_file = DEFAULT_OUTPUT
+    if hasattr(output_file, 'write'):
+        output = output_file
+    else:
+        output = open(output_file, 'w')
+    pages = 0
+    try:
+        write_output(output, prolog())
+        cells = []
+        for title, rect_coords in maps:
+            cells.append((title, rect_coords))
+            if len(cells) == per_page:
+                pages += 1
+                write_output(output, document_page(pages, cells, per_page))
+                cells = []
+        if cells or not pages:
+            pages += 1
+            write_output(output, document_page(pages, cells, per_page))
+        write_output(output, '%%%%Trailer\n%%%%Pages: %d\n%%%%EOF\n' % pages)
+    finally:
+        if output is not output_file:
+            output.close()
+    log.debug('leaving build_document')
+    return pages
+
+
+def document_page(number, cells, per_page=1):
+    """ The text for page number of a build_document() document, cells
+ being the (title, rect_coords) pairs on it. Each cell is the full page
+ map shrunk to fit its share of a grid per_page cells big, with the
+ title underneath. """
+    started = time.time()
+    columns = int(math.ceil(math.sqrt(per_page)))
+    rows = int(math.ceil(per_page / float(columns)))
+    width = (PAGE_WIDTH - 2 * PAGE_MARGIN) / float(columns)
+    height = (PAGE_HEIGHT - 2 * PAGE_MARGIN) / float(rows)
+    scale = min(width / PAGE_WIDTH, (height - TITLE_SIZE * 1.5) / PAGE_HEIGHT)
+    if per_page == 1:
+        scale = 1.0
+    page = ['%%%%Page: %d %d\nsave\n' % (number, number)]
+    for index, (title, rect_coords) in enumerate(cells):
+        row, column = divmod(index, columns)
+        x = PAGE_MARGIN + column * width
+        y = PAGE_HEIGHT - PAGE_MARGIN - (row + 1) * height
+        if per_page == 1:
+            x = y = 0
+        page.append('gsave %.2f %.2f translate\n' % (x, y))
+        if title:
+            margin = PAGE_MARGIN if per_page == 1 else 0
+            page.append('%d mapfont %.2f %.2f moveto (%s) show\n' %
+                        (TITLE_SIZE, margin, margin or TITLE_SIZE * 0.5,
+                         ps_escape(title)))
+        if per_page > 1:
+            page.append('0 %.2f translate %.6f dup scale '
+                        '0 0 %d %d rectclip\n' %
+                        (TITLE_SIZE * 1.5, scale, PAGE_WIDTH, PAGE_HEIGHT))
+        page.append('12 mapfont 10 cm 15 cm translate crosshair %s\n'
+                    'grestore\n' % map_marks(rect_coords))
+    page.append('restore showpage\n')
+    page = ''.join(page)
+    metrics.add('render', time.time() - started, len(page))
+    return page
+
+
+def ps_escape(text):
+    """ text made safe to go between ( and ) in postscript. """
+    return (text.replace('\\', '\\\\').replace('(', '\\(')
+            .replace(')', '\\)'))
+
+
+def ps_label(symbol):
+    """ A symbol as it goes in a postscript string. ( ) and \\ are escaped,
+    anything outside printable ascii but inside latin-1 is an octal escape
+    for the latin-1 font from label_font(), and anything past that, which
+    the standard fonts have no glyph for, is shown as its code point.
+    Multi symbol labels, n-grams, are done a symbol at a time. """
+    if len(symbol) != 1:
+        return ''.join(ps_label(part) for part in symbol)
+    code = ord(symbol)
+    if 32 <= code < 127:
+        return ps_escape(symbol)
+    if 160 <= code < 256:
+        return '\\%03o' % code
+    return 'U+%04X' % code
+
+
+def label_font(symbols):
+    """ Postscript to set the font for the symbol labels, nothing for the
+    usual ascii alphabet, which gets header()'s. Big alphabets get a smaller
+    font, and latin-1 symbols a Times-Roman re-encoded to ISOLatin1. """
+    size = 12.0
+    if len(symbols) > len(good_symbols):
+        size = max(3.0, 12.0 * math.sqrt(float(len(good_symbols)) /
+                                         len(symbols)))
+    latin = any(160 <= ord(part) < 256 for symbol in symbols
+                for part in symbol)
+    if size == 12.0 and not latin:
+        return ''
+    if not latin:
+        return '\n/Times-Roman findfont %.1f scalefont setfont\n' % size
+    return ('\n/Times-Roman findfont dup length dict begin\n'
+            '{1 index /FID ne {def} {pop pop} ifelse} forall\n'
+            '/Encoding ISOLatin1Encoding def currentdict end\n'
+            '/Times-Latin1 exch definefont pop\n'
+            '/Times-Latin1 findfont %.1f scalefont setfont\n' % size)
+
+
+def render_file(filename, use_mmap=True, cache=None):
+    """ Count filename and hand back its map as a postscript string. Plain
+ arguments and a plain result, so it can be shipped off to a worker
+ process. """
+    histogram = Histogram.from_file(filename, use_mmap=use_mmap, cache=cache)
+    return postscript_page(coordinates(histogram))
+
+
+def render_data(data):
+    """ Same as render_file(), for data already in memory. """
+    histogram = Histogram()
+    histogram.update(data)
+    return postscript_page(coordinates(histogram))
+
+
+def write_output(output_file, text):
+    """ Write a finished document out to a path, or to anything with a
+    write() method (which is left open), booked as 'write' in metrics. """
+    with metrics.stage('write', len(text)):
+        if not hasattr(output_file, 'write'):
+            output = open(output_file, 'w')
+            output.write(text)
+            output.close()
+            return
+        try:
+            output_file.write(text)
+        except TypeError:
+            # Wrong flavour of string for this file, our postscript is plain
+            # ascii so either one will do.
+            if isinstance(text, _unicode_type):
+                output_file.write(text.encode('ascii'))
+            else:
+                output_file.write(text.decode('ascii'))
+
+
+def build_ngram_postscript(dense, output_file=None, alphabet=good_symbols):
+    """ Draw dense bigram counts from count_ngrams() as a grid, first symbol
+ down the side, second along the top, each cell shaded darker the more
+ often that pair turns up (on a log scale, so the rare pairs still show).
+ Written to output_file, a path or file like object, DEFAULT_OUTPUT if
+ that isn't given. """
+    log.debug('in build_ngram_postscript')
+    if output_file is None:
+        output_file = DEFAULT_OUTPUT
+    started = time.time()
+    symbols = [chr(value) for value, _needle in _byte_table(alphabet)]
+    size = len(symbols)
+    cell = 372.0 / size
+    left = -size * cell / 2
+    top = size * cell / 2
+    biggest = max(dense) if dense else 0
+    scale = math.log(1 + biggest) if biggest else 1.0
+    page = [header(), ngram_grid(cell),
+            '/Times-Roman findfont %.2f scalefont setfont\n' % (cell * 0.8)]
+    for rank in range(size):
+        page.append('%.2f %.2f moveto (%s) show ' %
+                    (left - cell, top - (rank + 0.8) * cell, symbols[rank]))
+        page.append('%.2f %.2f moveto (%s) show\n' %
+                    (left + (rank + 0.2) * cell, top + 0.2 * cell,
+                     symbols[rank]))
+    for slot in range(len(dense)):
+        if dense[slot]:
+            row, col = divmod(slot, size)
+            page.append('%.3f %.2f %.2f cell\n' %
+                        (1 - math.log(1 + dense[slot]) / scale,
+                         left + col * cell, top - row * cell))
+    page.append(' showpage \r')
+    page = ''.join(page)
+    metrics.add('render', time.time() - started, len(page))
+    write_output(output_file, page)
+    log.debug('leaving build_ngram_postscript')
+
+
+def build_heatmap_postscript(entropies, block, output_file=None,
+                             title=''):
+    """ Draw per block entropies from block_entropy() as a heatmap, the
+ file running left to right and top to bottom, blue for low entropy through
+ to red at 8 bits per byte. Past HEATMAP_CELLS blocks each cell shows the
+ highest entropy of a run of blocks, so small encrypted or compressed bits
+ aren't averaged away. The picture goes in as one colorimage. Written to
+ output_file, a path or file like object, DEFAULT_OUTPUT if that isn't
+ given. """
+    log.debug('in build_heatmap_postscript')
+    if output_file is None:
+        output_file = DEFAULT_OUTPUT
+    started = time.time()
+    cells, group = heatmap_cells(entropies)
+    columns = max(1, int(math.ceil(math.sqrt(len(cells)))))
+    rows = max(1, -(-len(cells) // columns))
+    width = 16 * 72 / 2.54
+    height = width * rows / columns
+    left = -width / 2
+    top = height / 2
+    page = [header(),
+            '/Times-Roman findfont 10 scalefont setfont\n',
+            '%.2f %.2f moveto (%s) show\n' % (
+                left, top + 24, ps_escape(title)),
+            '%.2f %.2f moveto (%s, %d blocks of %s%s) show\n' % (
+                left, top + 10, format_size(len(entropies) * block),
+                len(entropies), format_size(block),
+                ', most entropic of every %d per cell' % group
+                if group > 1 else ''),
+            heatmap_image(cells, columns, rows, left, top - height, width,
+                          height)]
+    # Offsets down the right hand side, header()'s origin is only 10 cm
+    # (254pt) in from the left edge and the image takes nearly all of that.
+    for row in range(0, rows, max(1, rows // 8)):
+        page.append('%.2f %.2f moveto (%s) show\n' % (
+            left + width + 4, top - (row + 0.5) * height / rows - 3,
+            format_size(row * columns * group * block)))
+    page.append(heatmap_image([8.0 * step / 255 for step in range(256)],
+                              256, 1, left, top - height - 30, width, 10))
+    page.append('%.2f %.2f moveto (0 bits/byte) show\n' % (
+        left, top - height - 42))
+    page.append('%.2f %.2f moveto (8) show\n' % (
+        left + width - 6, top - height - 42))
+    page.append(' showpage \r')
+    page = ''.join(page)
+    metrics.add('render', time.time() - started, len(page))
+    write_output(output_file, page)
+    log.debug('leaving build_heatmap_postscript')
+
+
+def heatmap_cells(entropies):
+    """ entropies cut down to at most HEATMAP_CELLS, the max of each run of
+    blocks. Returns the cells and how many blocks went into each. """
+    group = max(1, -(-len(entropies) // HEATMAP_CELLS))
+    if group == 1:
+        return list(entropies), 1
+    if get_backend() == 'numpy':
+        import numpy as np
+        values = np.asarray(entropies, dtype=np.float32)
+        padded = np.zeros(-(-len(values) // group) * group, dtype=np.float32)
+        padded[:len(values)] = values
+        return padded.reshape(-1, group).max(axis=1).tolist(), group
+    return [max(entropies[start:start + group])
+            for start in range(0, len(entropies), group)], group
+
+
+def heatmap_image(cells, columns, rows, x, y, width, height):
+    """ colorimage of cells (entropies 0 to 8), columns by rows, filling
+    width by height points up from x y. Cells past the end are white. """
+    pixels = bytearray(b'\xff' * (columns * rows * 3))
+    for index, value in enumerate(cells):
+        shade = min(max(value / 8.0, 0.0), 1.0)
+        pixels[index * 3:index * 3 + 3] = bytearray([
+            int(255 * shade), int(255 * (1 - abs(2 * shade - 1))),
+            int(255 * (1 - shade))])
+    import binascii
+    data = binascii.hexlify(bytes(pixels)).decode('ascii')
+    lines = [data[start:start + 72] for start in range(0, len(data), 72)]
+    return ('gsave %.2f %.2f translate %.2f %.2f scale\n'
+            '/picstr %d string def\n'
+            '%d %d 8 [%d 0 0 %d neg 0 %d]\n'
+            '{currentfile picstr readhexstring pop} false 3 colorimage\n'
+            '%s\ngrestore\n' % (x, y, width, height, columns * 3, columns,
+                                  rows, columns, rows, rows,
+                                  '\n'.join(lines)))
+
+
+def ngram_grid(cell):
+    """ The /cell procedure for the bigram grid, gray x y cell fills the
+    square hanging down and right from x y. """
+    return """
+        /cell {
+                newpath moveto
+                %(cell).2f 0 rlineto 0 -%(cell).2f rlineto
+                -%(cell).2f 0 rlineto closepath
+                setgray fill
+                } def
+""" % {'cell': cell}
+
 
 def crosshair():
     """ Create the crosshair reticule for the display """
     log.debug('in crosshair')
-    target = """
+    target = crosshair_proc() + """
+        crosshair """
+    log.debug('leaving crosshair')
+    return target
+
+
+def crosshair_proc():
+    """ The /crosshair procedure on its own, for a prolog. """
+    return """
         /crosshair {
                 gsave
                 newpath
@@ -236,10 +3603,7 @@ def crosshair():
                 -1 cal  0 cal  lineto
                 stroke
                 grestore
-                } def
-        crosshair """
-    log.debug('leaving crosshair')
-    return target
+                } def"""
 
 
 def header():
@@ -261,19 +3625,276 @@ def header():
     return ps_header
 
 
-def run():
-    """ The run() function, start here, note, there are no relevant args yet"""
+def prolog():
+    """ The header for a many page document from build_document(), with
+ the page count left to the trailer and everything the pages share
+ defined once. Pages set their own font with size mapfont. """
+    return """%!PS-Adobe-3.0
+%%DocumentData: Clean7Bit
+%%Orientation: Portrait
+%%Pages: (atend)
+%%PageOrder: Ascend
+%%Title: textmap
+%%EndComments
+%%BeginProlog
+/cm {25.4 mul} def
+/cal {250 mul} def
+/mapfont {/Times-Roman findfont exch scalefont setfont} def""" + \
+        crosshair_proc() + """
+%%EndProlog
+"""
+
+
+def emit_metrics(output_file, **extra):
+    """ Append this run's metrics, with extra, as one line of json to
+    output_file, or stdout if that is '-'. """
+    import json
+    line = json.dumps(metrics.record(**extra), sort_keys=True) + '\n'
+    if output_file == '-':
+        sys.stdout.write(line)
+        return
+    output = open(output_file, 'a')
+    output.write(line)
+    output.close()
+
+
+def finish_sketch(sketch, args):
+    """ Save, print and draw a finished sketch as the command line asks. """
+    if args.save_sketch:
+        sketch.save(args.save_sketch)
+    sys.stdout.write(format_sketch(sketch, args.report))
+    draw_map(dict((gram_label(gram), count)
+                  for gram, count, _low in sketch.grams()), args.output)
+
+
+def run(args):
+    """ The run() function, start here, with the parsed command line
+    options from get_options(). """
     log.debug('in run')
-    if args.inputfile:
-        name = args.inputfile
-    else:
-        # No filename given, ask for one. Note buffer overrun
-        # possibility. Also, this takes pathname as part of filename,
-        # bigtime doubleplusungood
-        name = str(raw_input(' need a filename please! : '))
+    cache = HistogramCache(args.cache_dir, args.cache_size, args.cache_hash)
+    if args.clear_cache:
+        cache.clear()
+    if not args.cache:
+        cache = None
+    batch = list(args.batch)
+    if args.batch_list:
+        batch.extend(read_listing(args.batch_list))
+    if batch and args.combine:
+        if args.per_page < 1:
+            log.error('--per-page needs to be at least 1')
+            return 1
+        failed = run_combined(batch, args.output, args.per_page,
+                              jobs=args.jobs, use_mmap=args.mmap, cache=cache)
+        log.debug('leaving run')
+        return 1 if failed else 0
+    if batch:
+        failed = run_batch(batch, args.output_template or BATCH_TEMPLATE,
+                           jobs=args.jobs, use_mmap=args.mmap,
+                           timeout=args.timeout, cache=cache)
+        log.debug('leaving run')
+        return 1 if failed else 0
+    compared = list(args.compare)
+    if args.compare_list:
+        compared.extend(read_listing(args.compare_list))
+    if compared:
+        failed = run_compare(compared, args.reference, args.report,
+                             jobs=args.jobs, use_mmap=args.mmap, cache=cache)
+        log.debug('leaving run')
+        return 1 if failed else 0
+    if args.merge_sketch:
+        sketch = None
+        try:
+            for path in args.merge_sketch:
+                loaded = NgramSketch.load(path)
+                sketch = loaded if sketch is None else sketch.merge(loaded)
+        except (EnvironmentError, ValueError, struct.error) as Err:
+            log.error('cannot merge %s, %s', path, Err)
+            return 1
+        sketch.top = args.top
+        finish_sketch(sketch, args)
+        log.debug('leaving run')
+        return 0
+    shards = list(args.merge)
+    if args.merge_list:
+        shards.extend(read_listing(args.merge_list))
+    if shards:
+        histogram, merged = merge_histograms(shards)
+        if not merged:
+            log.error('none of the histograms could be read')
+            return 1
+        if args.emit:
+            save_histogram(histogram, args.emit,
+                           source='merge of %d histograms' % merged)
+        else:
+            draw_map(histogram.as_dict(), args.output)
+        log.debug('leaving run')
+        return 0 if merged == len(shards) else 1
+    if not args.inputfile:
+        # stdin only when asked for, a job that forgot -f shouldn't sit
+        # waiting on whatever stdin it happened to inherit.
+        log.error('need a filename please, -f <file>, or -f - for stdin')
+        return 1
+    name = args.inputfile
+    if name == '-' and (args.follow or args.build_index or args.sweep or
+                        args.range or args.checkpoint):
+        log.error('--follow, --build-index, --sweep, --range and '
+                  '--checkpoint need a real file, not stdin')
+        return 1
+    checkpoint = None
+    if args.checkpoint:
+        checkpoint = Checkpoint(args.checkpoint, args.checkpoint_every,
+                                args.checkpoint_seconds)
+    elif args.resume:
+        log.error('--resume needs the --checkpoint to resume from')
+        return 1
+
+    if is_corpus(name):
+        files = corpus_files(name, args.include, args.exclude,
+                             args.follow_links)
+        try:
+            histogram, progress = scan_corpus(
+                files, jobs=args.jobs, use_mmap=args.mmap, cache=cache,
+                per_file=args.per_file,
+                progress=Progress(sys.stderr if args.progress else None),
+                checkpoint=checkpoint, resume=args.resume,
+                source=dict(scan_source(name), include=args.include,
+                            exclude=args.exclude,
+                            follow_links=args.follow_links))
+        except ValueError as Err:
+            log.error('cannot resume, %s', Err)
+            return 1
+        log.info('%s', progress.line())
+        if not progress.files and not progress.resumed:
+            log.error('no files found for %s', name)
+            return 1
+        if args.emit:
+            save_histogram(histogram, args.emit, source=name)
+        else:
+            draw_map(histogram, args.output)
+        log.debug('leaving run')
+        return 1 if progress.failed else 0
+
+    if args.follow:
+        follow(name, args.output, interval=args.interval, every=args.every)
+        log.debug('leaving run')
+        return 0
+
+    if args.entropy:
+        entropies = entropy_file(name, args.entropy, args.mmap,
+                                 args.decompress, args.jobs)
+        if args.entropy_dump:
+            dump_entropy(entropies, args.entropy, args.entropy_dump)
+        build_heatmap_postscript(entropies, args.entropy, args.output,
+                                 'stdin' if name == '-' else name)
+        log.debug('leaving run')
+        return 0
+
+    if args.sketch:
+        sketch = NgramSketch(args.sketch, args.sketch_memory,
+                             args.sketch_depth, args.top)
+        sketch.update(open_file(name, use_mmap=args.mmap,
+                                decompress=args.decompress))
+        finish_sketch(sketch, args)
+        log.debug('leaving run')
+        return 0
 
-    data = open_file(name)
-    massage(data)
+    if args.ngram > 1:
+        dense = count_ngrams(open_file(name, use_mmap=args.mmap,
+                                       decompress=args.decompress),
+                             args.ngram)
+        if args.ngram == 2:
+            build_ngram_postscript(dense, args.output)
+        else:
+            draw_map(ngram_dict(dense, args.ngram, top=args.top), args.output)
+        log.debug('leaving run')
+        return 0
+
+    if args.sweep:
+        window, _sep, step = args.sweep.partition(':')
+        window = parse_size(window)
+        step = parse_size(step) if step else window
+        if window <= 0 or step <= 0:
+            # a step of 0 would draw the first window forever
+            log.error('--sweep needs a window and step of more than 0 bytes')
+            return 1
+    if (args.build_index or args.sweep) and args.index_block <= 0:
+        log.error('--index-block has to be more than 0 bytes')
+        return 1
+    index = None
+    if args.build_index or args.sweep:
+        index = open_index(name, args.index_block, args.build_index)
+    elif args.range:
+        try:
+            index = SymbolIndex(name)
+        except (EnvironmentError, ValueError, struct.error):
+            index = None
+        if index is not None and not index.fresh():
+            index = None
+    if args.sweep:
+        template = args.output_template or SWEEP_TEMPLATE
+        if not any(field in template
+                   for field in ('{start}', '{end}', '{index}')):
+            log.error('every window of --sweep would be written to the same '
+                      'file, add {start}, {end} or {index} to the output '
+                      'template')
+            return 1
+        sweep(name, window, step, template, index)
+        log.debug('leaving run')
+        return 0
+    if args.range:
+        start, end = args.range
+        if index is not None:
+            histogram = index.histogram(start, end)
+        else:
+            histogram = new_histogram()
+            count_chunks(open_file(name, use_mmap=args.mmap, start=start,
+                                   end=end), histogram)
+        draw_map(histogram_to_dict(histogram), args.output)
+        log.debug('leaving run')
+        return 0
+    if args.utf8:
+        counter = SymbolCounter.from_file(name, use_mmap=args.mmap,
+                                          decompress=args.decompress)
+        draw_map(counter, args.output)
+        log.debug('leaving run')
+        return 0
+    if args.sample is not None or args.budget_time or args.budget_bytes:
+        try:
+            sample = sample_file(
+                name, 1.0 if args.sample is None else args.sample,
+                args.sample_block, args.sample_spread, args.budget_time,
+                args.budget_bytes, args.seed, args.mmap)
+        except ValueError as Err:
+            log.warning('%s, counting all of it instead', Err)
+        else:
+            # Keep stdout clean when the histogram itself is going there.
+            (sys.stderr if args.emit == '-' else sys.stdout).write(
+                sample.note() + '\n')
+            if args.emit:
+                save_histogram(sample.counts, args.emit,
+                               source='%s (sampled %.2f%%)' % (
+                                   name, 100.0 * sample.fraction()))
+            else:
+                draw_map(histogram_to_dict(sample.counts), args.output,
+                         note=sample.note())
+            log.debug('leaving run')
+            return 0
+    if checkpoint is not None:
+        try:
+            histogram = checkpointed_count(name, checkpoint, args.resume,
+                                           use_mmap=args.mmap,
+                                           decompress=args.decompress)
+        except ValueError as Err:
+            log.error('cannot resume, %s', Err)
+            return 1
+    else:
+        histogram = count_file(name, jobs=args.jobs, use_mmap=args.mmap,
+                               cache=cache, decompress=args.decompress)
+    if args.emit:
+        save_histogram(histogram, args.emit,
+                       source='stdin' if name == '-' else name)
+    else:
+        draw_map(histogram_to_dict(histogram), args.output)
     log.debug('leaving run')
 
 
@@ -281,11 +3902,28 @@ if __name__ == "__main__":
     # This is where we will begin when called from CLI. No need for argparse
     # unless being called interactively, so import it here, or at least, in
     # get_options
+    setup_logging()
     args = get_options()
 
     if args.debug:
         log.setLevel(logging.DEBUG)
     else:
         log.setLevel(logging.WARN)
+    set_backend(args.backend)
 
-    sys.exit(run())
+    profiler = None
+    if args.cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    status = run(args)
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.cprofile)
+    if args.profile:
+        sys.stderr.write(metrics.report())
+    if args.metrics_json:
+        emit_metrics(args.metrics_json, input=args.inputfile,
+                     output=args.output, backend=get_backend(),
+                     status=status or 0)
+    sys.exit(status)